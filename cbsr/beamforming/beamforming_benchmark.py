@@ -0,0 +1,290 @@
+from argparse import ArgumentParser
+from sys import exit
+from threading import Thread
+from timeit import default_timer, timeit
+from tracemalloc import get_traced_memory, start, stop
+
+import numpy as np
+from scipy.io import wavfile
+from scipy.linalg import toeplitz
+
+from beamforming_service import BeamformingService, BUFFER_SIZE, CHANNELS, SAMPLE_RATE, WINDOW_SIZE, WINDOW_SIZE_FRAME
+from multi_microphone.das import MultiMicrophoneEnhancement
+from multi_microphone.doa_tracker import BUDGET, CHANGE_THRESHOLD, DOATracker, MAX_AGE
+from multi_microphone.music_pra import C, MUSIC
+from single_microphone.noise_tracking import _estimate_variance, _estimate_variance_bias
+from tools.ring_buffer import RingBuffer
+from tools.utils import bartlett_estimate, exponential_smoothening
+
+
+class ReplayStream(object):
+    """
+    Stands in for a BeamformingService: the chunks of a recording are written to the buffer (by a thread, like
+    fill_buffer) and read through BeamformingService.get_next_window, until all of them have been used.
+    """
+
+    def __init__(self, chunks):
+        self.music = MUSIC(WINDOW_SIZE_FRAME, SAMPLE_RATE)
+        self.buffer = RingBuffer(BUFFER_SIZE, CHANNELS)
+        self.chunks = chunks
+
+    def start(self):
+        buffering_thread = Thread(target=self.fill_buffer)
+        buffering_thread.daemon = True
+        buffering_thread.start()
+
+    def fill_buffer(self):
+        for chunk in self.chunks:
+            self.buffer.write(chunk)
+        self.buffer.close()
+
+
+def synthesize(seconds, azimuth, snr, seed=0, jump_azimuth=None):
+    """
+    A harmonic, amplitude modulated 'voice' arriving from the given azimuth (in degrees) at the microphones
+    of Pepper's head, plus independent white noise on every microphone at the given SNR (in dB).
+    If a jump_azimuth is given, the voice arrives from there during the second half.
+    :return: the noisy 4-channel int16 signal, and the clean signal at every microphone
+    """
+    rng = np.random.RandomState(seed)
+    n = int(seconds * SAMPLE_RATE)
+    t = np.arange(n) / float(SAMPLE_RATE)
+    pitch = 150 + 30 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+    voice = sum(np.sin(harmonic * phase) / harmonic for harmonic in range(1, 15))
+    voice *= 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t) ** 2
+
+    clean = delay_far_field(voice, azimuth)
+    if jump_azimuth is not None:
+        clean[n // 2:] = delay_far_field(voice, jump_azimuth)[n // 2:]
+
+    clean *= 8000 / np.abs(clean).max()
+    noise = rng.standard_normal(clean.shape) * np.sqrt(np.mean(clean ** 2) / 10 ** (snr / 10.0))
+    return np.clip(np.round(clean + noise), -32768, 32767).astype(np.int16), clean
+
+
+def delay_far_field(signal, azimuth):
+    """
+    Far field: delay the signal at every microphone by its distance along the direction of arrival
+    """
+    direction = np.array([np.cos(np.radians(azimuth)), np.sin(np.radians(azimuth)), 0.0])
+    delays = -MUSIC(WINDOW_SIZE_FRAME, SAMPLE_RATE).create_mic_array().R.T.dot(direction) / C
+    spectrum = np.fft.rfft(signal)
+    freqs = np.fft.rfftfreq(len(signal), 1.0 / SAMPLE_RATE)
+    return np.stack([np.fft.irfft(spectrum * np.exp(-2j * np.pi * freqs * delay), len(signal)) for delay in delays],
+                    axis=1)
+
+
+def load(path):
+    """
+    :param path: a 4-channel WAV file, or raw interleaved int16 (as in audio_stream_multi)
+    """
+    if path.endswith('.wav'):
+        sample_rate, signal = wavfile.read(path)
+        if sample_rate != SAMPLE_RATE or signal.ndim != 2 or signal.shape[1] != CHANNELS:
+            raise ValueError('Expected %d channels at %d Hz' % (CHANNELS, SAMPLE_RATE))
+        return signal.astype(np.int16)
+    signal = np.fromfile(path, dtype=np.int16)
+    return signal[:len(signal) - len(signal) % CHANNELS].reshape((-1, CHANNELS))
+
+
+def snr_db(reference, signal):
+    """
+    SNR of a signal against a reference, after aligning both (by cross-correlation) and scaling the reference
+    """
+    n = min(len(reference), len(signal))
+    size = 1 << int(np.ceil(np.log2(2 * n)))
+    correlation = np.fft.irfft(np.fft.rfft(signal[:n], size) * np.conj(np.fft.rfft(reference[:n], size)), size)
+    lag = int(np.argmax(correlation))
+    if lag > size // 2:
+        lag -= size
+    if lag >= 0:
+        signal, reference = signal[lag:], reference[:len(reference) - lag]
+    else:
+        signal, reference = signal[:lag], reference[-lag:]
+    n = min(len(reference), len(signal))
+    signal, reference = signal[:n].astype(np.float64), reference[:n]
+    gain = signal.dot(reference) / reference.dot(reference)
+    residual = signal - gain * reference
+    return 10 * np.log10(np.sum((gain * reference) ** 2) / np.sum(residual ** 2))
+
+
+def check_parity(signal, windows=8):
+    """
+    Compare the batched beamformer with the per segment one on the first windows of the signal
+    :return: whether they match
+    """
+    enhancement = MultiMicrophoneEnhancement(ReplayStream([]), WINDOW_SIZE)
+    fft_freqs = np.fft.rfftfreq(WINDOW_SIZE_FRAME, 1.0 / SAMPLE_RATE)
+    error = 0.0
+    for start in range(0, min(windows * WINDOW_SIZE, len(signal) - WINDOW_SIZE + 1), WINDOW_SIZE):
+        signal_window = signal[start:start + WINDOW_SIZE]
+        num_segments, _, y_k_segments = enhancement.segment_signal_window(signal_window, CHANNELS)
+        enhancement.music.process_chunk(signal_window)
+        vector = enhancement.music.doa.mode_vec.mode_vec[:, :, enhancement.music.doa.src_idx[0]]
+        batched = enhancement.compute_clean_signal(y_k_segments, vector, CHANNELS)
+        per_segment = np.concatenate([enhancement.compute_clean_signal_segment(y_k_segments, segment, vector,
+                                                                               fft_freqs, CHANNELS)
+                                      for segment in range(num_segments)])
+        error = max(error, np.abs(batched - per_segment).max() / np.abs(per_segment).max())
+    matches = error < 1e-9
+    print('Beamformer parity: max relative difference %.2e (%s)' % (error, 'OK' if matches else 'MISMATCH'))
+    return matches
+
+
+def dense_variance(pyy, window_size):
+    """
+    Reference for _estimate_variance (without its smoothing): the minimum of every row of the (l, d) matrix
+    with the d - 1 values before every bin
+    """
+    l = pyy.shape[0]
+    d = int(l * window_size)
+    q_vec = np.zeros((l, d))
+    for row in range(1, l):
+        window_start = max(row - d + 1, 0)
+        window_end = row + max(0, d - row)
+        q_vec[row, 0:window_end - window_start] = pyy[window_start:window_end]
+    return np.min(_estimate_variance_bias(q_vec, d), axis=1)
+
+
+def recursive_smoothening(x, alpha):
+    """
+    Reference for exponential_smoothening
+    """
+    res = np.empty_like(x)
+    res[0] = (1 - alpha) * x[0]
+    for l in range(1, x.shape[0]):
+        res[l] = alpha * res[l - 1] + (1 - alpha) * x[l]
+    return res / (1 - alpha ** np.arange(1, x.shape[0] + 1))
+
+
+def check_noise_tracking_parity(signal, window_size_frame=2 ** 10, windows=(2 ** -2, 0.05, 0.01), alpha=0.05):
+    """
+    Compare the noise variance estimate and the exponential smoothening with their (loop based) references
+    on the spectra of the first channel
+    :return: whether they match
+    """
+    pyys = np.square(np.abs(np.fft.fft(signal[:16 * window_size_frame, 0].reshape((-1, window_size_frame)), axis=1)))
+    variance_error = smoothening_error = 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for pyy in pyys:
+            for window in windows:
+                expected = exponential_smoothening(dense_variance(pyy, window), alpha)
+                variance = _estimate_variance(pyy, window, alpha)
+                variance_error = max(variance_error, np.nanmax(np.abs(variance - expected)))
+            expected = recursive_smoothening(pyy, alpha)
+            smoothening_error = max(smoothening_error,
+                                    np.abs(exponential_smoothening(pyy, alpha) - expected).max() / expected.max())
+    matches = variance_error == 0 and smoothening_error < 1e-12
+    print('Noise tracking parity: variance max difference %.2e, smoothening max relative difference %.2e (%s)'
+          % (variance_error, smoothening_error, 'OK' if matches else 'MISMATCH'))
+    return matches
+
+
+def toeplitz_bartlett_estimate(x, window_size):
+    """
+    Reference for bartlett_estimate: a (dense) Toeplitz matrix with the normalized windows as rows
+    """
+    l = x.shape[0]
+    m = round(l * window_size)
+    c0 = np.zeros(l, dtype=bool)
+    c0[0:m] = 1
+    r0 = np.zeros(l, dtype=bool)
+    r0[0] = 1
+    t = toeplitz(c0, r0)
+    return (t / t.sum(axis=1)[:, np.newaxis]) @ x
+
+
+def benchmark_bartlett(sizes=(256, 1024, 4096), window_size=2 ** -6, number=20):
+    """
+    Time bartlett_estimate against the Toeplitz matrix (including building it, as for every new size)
+    :return: whether their estimates match for all sizes
+    """
+    rng = np.random.RandomState(0)
+    matches = True
+    for size in sizes:
+        pyy = np.square(np.abs(np.fft.fft(rng.standard_normal(size))))
+        expected = toeplitz_bartlett_estimate(pyy, window_size)
+        error = np.max(np.abs(bartlett_estimate(pyy, window_size) - expected) / pyy.max())
+        seconds = timeit(lambda: bartlett_estimate(pyy, window_size), number=number) / number
+        toeplitz_seconds = timeit(lambda: toeplitz_bartlett_estimate(pyy, window_size), number=number) / number
+        matches = matches and error < 1e-12
+        print('Bartlett estimate of %d bins: %.3f ms, Toeplitz %.3f ms (max relative difference %.1e, %s)'
+              % (size, seconds * 1000, toeplitz_seconds * 1000, error, 'OK' if error < 1e-12 else 'MISMATCH'))
+    return matches
+
+
+def run(signal, chunk_size, clean=None, trace_memory=False, batched=True, post_process=False, doa_settings=None):
+    chunks = [signal[start:start + chunk_size] for start in range(0, len(signal) - chunk_size + 1, chunk_size)]
+    stream = ReplayStream(chunks)
+    doa_tracker = DOATracker(stream.music, WINDOW_SIZE // 2, **(doa_settings or {}))
+    enhancement = MultiMicrophoneEnhancement(stream, WINDOW_SIZE, batched=batched, doa_tracker=doa_tracker)
+
+    if trace_memory:  # slows down the processing itself
+        start()
+    outputs = []
+    latencies = []
+    stream.start()
+    begin = previous = default_timer()
+    windows = BeamformingService.get_next_window(stream.buffer, WINDOW_SIZE)
+    for output in enhancement.enhance_speech_music(windows, post_process=post_process):
+        now = default_timer()
+        latencies.append(now - previous)
+        previous = now
+        outputs.append(np.asarray(output, dtype=np.int16))
+    elapsed = default_timer() - begin
+    if trace_memory:
+        _, peak = get_traced_memory()
+        stop()
+
+    seconds = len(chunks) * chunk_size / float(SAMPLE_RATE)
+    latencies = np.array(latencies) * 1000
+    print('%.1f s of audio in %d windows: real-time factor %.3f (%.1fx faster than real time)'
+          % (seconds, len(latencies), elapsed / seconds, seconds / elapsed))
+    print('Per window: mean %.2f ms, p50 %.2f ms, p99 %.2f ms, max %.2f ms (a window step is %.1f ms)'
+          % (latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.max(),
+             WINDOW_SIZE // 2 * 1000.0 / SAMPLE_RATE))
+    print(doa_tracker)
+    if trace_memory:
+        print('Peak memory allocated while processing: %.1f MB' % (peak / 1e6))
+    if clean is not None and outputs:
+        snr_in = snr_db(clean[:, 0], signal[:, 0])
+        snr_out = snr_db(clean[:, 0], np.concatenate(outputs))
+        print('SNR: %.2f dB in, %.2f dB out (%+.2f dB)' % (snr_in, snr_out, snr_out - snr_in))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Real-time factor, latency, memory and SNR of the beamforming pipeline '
+                                        '(run from the beamforming directory)')
+    parser.add_argument('--input', type=str, help='4-channel 48 kHz int16 WAV or raw file (synthetic if not given)')
+    parser.add_argument('--seconds', type=float, default=20, help='Length of the synthetic signal')
+    parser.add_argument('--azimuth', type=float, default=90, help='Direction of the synthetic source (degrees)')
+    parser.add_argument('--jump', type=float, help='Direction of the synthetic source in the second half (degrees)')
+    parser.add_argument('--snr', type=float, default=0, help='SNR of the synthetic signal (dB)')
+    parser.add_argument('--chunk', type=int, default=4096, help='Samples per channel in every audio_stream_multi chunk')
+    parser.add_argument('--memory', action='store_true', help='Also trace the memory (slower)')
+    parser.add_argument('--per-segment', action='store_true', help='Beamform per segment instead of batched')
+    parser.add_argument('--post-process', action='store_true', help='Enable the single microphone post-processing')
+    parser.add_argument('--doa-threshold', type=float, default=CHANGE_THRESHOLD,
+                        help='Min. change of the spatial covariance for a new MUSIC run (< 0: only when stale)')
+    parser.add_argument('--doa-max-age', type=int, default=MAX_AGE, help='Max. nr. of windows between MUSIC runs')
+    parser.add_argument('--doa-budget', type=float, default=BUDGET, help='Max. fraction of real time for MUSIC')
+    parser.add_argument('--bartlett', action='store_true', help='Only benchmark the Bartlett PSD estimate')
+    args = parser.parse_args()
+
+    # A mismatch with the reference implementations fails the run (with exit status 1)
+    if args.bartlett:
+        if not benchmark_bartlett():
+            exit(1)
+    else:
+        if args.input:
+            noisy, clean_signal = load(args.input), None
+        else:
+            noisy, clean_signal = synthesize(args.seconds, args.azimuth, args.snr, jump_azimuth=args.jump)
+        beamformer_matches = check_parity(noisy)
+        noise_tracking_matches = check_noise_tracking_parity(noisy)
+        if not (beamformer_matches and noise_tracking_matches):
+            exit(1)
+        doa = {'threshold': args.doa_threshold if args.doa_threshold >= 0 else None,
+               'max_age': args.doa_max_age, 'budget': args.doa_budget}
+        run(noisy, args.chunk, clean_signal, args.memory, not args.per_segment, args.post_process, doa)
@@ -1,11 +1,16 @@
+from os.path import dirname, join
+
 import numpy as np
 
+from multi_microphone.doa_tracker import DOATracker
 from single_microphone.gain import power_spectral_subtraction
 from single_microphone.single_microphone_enhancement import SingleMicrophoneEnhancement
-from tools.segmentation import framing, overlap_add
+from tools.segmentation import get_plan
 from tools.utils import estimate_psd
 
 COMPLEX_TYPE = np.complex128
+# Power Spectral Density of pre-recorded noise (on-board fan), psd_fan_noise[channel][segment][freq]
+PSD_FAN_NOISE = join(dirname(dirname(__file__)), 'psd_fan_noise.npy')
 
 
 class MultiMicrophoneEnhancement(object):
@@ -13,50 +18,44 @@ class MultiMicrophoneEnhancement(object):
     Class to perform a multi microphone enhancement
     """
 
-    def __init__(self, stream, window_size):
+    def __init__(self, stream, window_size, batched=True, doa_tracker=None):
         """
         Class containing all required parameters and functions for a Delay-And-Sum beamformer tailored for Pepper
 
-        :param stream: Stream object containing stream_get_next_window function
+        :param stream: Stream object containing the MUSIC object (music) for its audio
         :param window_size: Size of data chunk to process and segment
+        :param batched: True to beamform all segments at once (compute_clean_signal), False for per segment
+        :param doa_tracker: DOATracker that decides when to run MUSIC (default: one with the default settings)
         """
         self.stream = stream
         self.window_size = window_size
+        self.batched = batched
         self.step_size = window_size // 2
         self.music = stream.music
         self.window_size_frame = self.music.window_size_frame
         self.sample_rate = self.music.sample_rate
+        self.plan = get_plan(self.window_size_frame)
+        self.doa_tracker = doa_tracker if doa_tracker is not None else DOATracker(self.music, self.step_size)
 
         # PSD for pre-beamformer processing
         self.psd_window_size = 1.0
-        self.psd_per_channel = None
+        self.psd_per_channel = np.load(PSD_FAN_NOISE)
 
     # Preprocessing
     def preprocess_pss(self, y_k_segments, channels):
         """
-        Preprocess signal using pre-recorded noise signal and Power Spectral Subtraction
+        Preprocess signal using pre-recorded noise signal and Power Spectral Subtraction, for all channels at once
         Requires self.psd_per_channel as ground truth.
 
-        :param y_k_segments: Freq. Domain signal in segments
+        :param y_k_segments: Freq. Domain signal in segments, y_k_segments[channel][segment][freq]
         :param channels: Nr. of channels
         :return: Preprocessed signal in freq. domain
         """
-        # Load Power Spectral Density of pre-recorded noise (on-board fan)
-        if self.psd_per_channel is None:
-            self.psd_per_channel = np.load('psd_fan_noise.npy')
-
-        # Estimate Power Spectral Density
-        pyy = np.zeros_like(y_k_segments)
-        for chan in range(channels):
-            pyy[chan] = estimate_psd(y_k_segments[chan], self.psd_window_size)
+        # Estimate Power Spectral Density (over the segments, i.e. the second axis)
+        pyy = np.swapaxes(estimate_psd(np.swapaxes(y_k_segments, 0, 1), self.psd_window_size), 0, 1)
 
         # Power Spectral Subtraction using estimation and pre-recorded noise PSD
-        y_k_segments_pss = np.zeros_like(y_k_segments)
-        for chan in range(channels):
-            y_k_segments_pss[chan] = power_spectral_subtraction(y_k_segments[chan], pyy[chan],
-                                                                self.psd_per_channel[chan], min_=0.1)
-
-        return y_k_segments_pss
+        return power_spectral_subtraction(y_k_segments, pyy, self.psd_per_channel[:channels], min_=0.1, axis=(1, 2))
 
     # Processing
     def segment_signal_window(self, signal_window, channels):
@@ -66,38 +65,33 @@ class MultiMicrophoneEnhancement(object):
         :param channels: Nr. of channels
         :return: num_segments, y_segments (time-domain), y_k_segments[channel][segment][freq] (freq-domain)
         """
-        y_segments = [[], [], [], []]
-        y_k_segments = [[], [], [], []]
+        y_segments = self.plan.framing(signal_window[:, :channels])
+        y_k_segments = np.fft.rfft(y_segments, axis=-1)
 
-        for channel in range(channels):
-            signal_window_chan = signal_window[:, channel]
-            y_segments[channel] = framing(signal_window_chan, self.sample_rate,
-                                          window_size_frame=self.window_size_frame)
-            y_k_segments[channel] = np.fft.rfft(y_segments[channel], axis=1)
-
-        num_segments = y_k_segments[0].shape[0]
+        num_segments = y_k_segments.shape[1]
         return num_segments, y_segments, y_k_segments
 
-    def enhance_speech_music(self, pre_process=True, post_process=False):
+    def enhance_speech_music(self, windows, pre_process=True, post_process=False):
         """
         Enhance speech signal to estimate clean speech signal using a Delay-And-Sum beamformer, from audio stream
+        :param windows: The (overlapping) signal windows of the stream, windows[window][sample][channel]
         :param pre_process: True if preprocessing with Power Spectral Subtraction (need PSD of noise)
         :param post_process: True if postprocessing using Power Spectral Subtraction is wanted
         :return: Estimated clean speech signal
         """
         processed_data = None
-        vector = None
+        if post_process:
+            post_filter = SingleMicrophoneEnhancement(
+                window_size_frame=2 ** 10, psd_window_factor=2 ** -6,
+                variance_window_factor=2 ** -2, sample_rate=self.sample_rate)
 
         # For each received chunk
-        for chunk_nr, signal_window in enumerate(self.stream.get_next_window(self.window_size)):
+        for chunk_nr, signal_window in enumerate(windows):
             channels = signal_window.shape[1]
             num_segments, y_segments, y_k_segments = self.segment_signal_window(signal_window, channels)
 
-            if (chunk_nr % 2) == 0 or vector is None:
-                # New vector method using MUSIC found peak and mode vector (assuming single source)
-                self.music.process_chunk(signal_window)
-                vector = self.music.doa.mode_vec.mode_vec[:, :, self.music.doa.src_idx[0]]
-                # print(vector)
+            # Mode vector of the peak found by MUSIC (assuming single source), if it has to be updated
+            vector = self.doa_tracker.update(signal_window, y_k_segments)
 
             # Preprocessing PSS (Remove fan noise)
             if pre_process and chunk_nr > 1:
@@ -105,32 +99,46 @@ class MultiMicrophoneEnhancement(object):
             else:
                 y_k_segments_pss = y_k_segments
 
-            # For each segment process:
-            fft_freqs = np.fft.rfftfreq(y_segments[0].shape[1], 1 / self.sample_rate)
-            s_k_estimates = np.zeros(y_k_segments_pss[0].shape, dtype=COMPLEX_TYPE)
+            if self.batched:
+                s_k_estimates = self.compute_clean_signal(y_k_segments_pss, vector, channels)
+            else:
+                # For each segment process:
+                fft_freqs = np.fft.rfftfreq(y_segments[0].shape[1], 1 / self.sample_rate)
+                s_k_estimates = np.zeros(y_k_segments_pss[0].shape, dtype=COMPLEX_TYPE)
 
-            for segment in range(num_segments):
-                s_k_estimates[segment, :] = self.compute_clean_signal_segment(y_k_segments_pss, segment,
-                                                                              vector, fft_freqs,
-                                                                              channels)
+                for segment in range(num_segments):
+                    s_k_estimates[segment, :] = self.compute_clean_signal_segment(y_k_segments_pss, segment,
+                                                                                  vector, fft_freqs,
+                                                                                  channels)
 
             # Back to time-domain and non-segmented
-            s_estimates = np.fft.irfft(s_k_estimates, axis=1)
-            s_estimate = overlap_add(s_estimates)
-
-            # Post-beamformer Single Channel Enhancement
-            if post_process:
-                pss = SingleMicrophoneEnhancement(
-                    window_size_frame=2 ** 10, psd_window_factor=2 ** -6,
-                    variance_window_factor=2 ** -2, sample_rate=self.sample_rate)
-                s_estimate_post_pss = pss.enhance_speech_no_stream(s_estimate)
-            else:
-                s_estimate_post_pss = s_estimate
+            s_estimate = self.plan.istft(s_k_estimates)
 
             # Collect all processed data, yield for stream
-            processed_data = self.append_processed_data(processed_data, s_estimate_post_pss)
+            processed_data = self.append_processed_data(processed_data, s_estimate)
             if processed_data is not None:
-                yield processed_data[-self.window_size: -self.step_size]
+                s_estimate_done = processed_data[-self.window_size: -self.step_size]
+                # Post-beamformer Single Channel Enhancement, continuing over the windows
+                if post_process:
+                    s_estimate_done = post_filter.enhance_speech(s_estimate_done)
+                if s_estimate_done.shape[0] > 0:
+                    yield s_estimate_done
+
+        if post_process:
+            yield post_filter.flush()
+
+    @staticmethod
+    def compute_clean_signal(y_k_segments, steering_vectors, channels):
+        """
+        Compute clean signal estimates of all segments at once, as compute_clean_signal_segment does per segment
+        :param y_k_segments: Segmented signal in freq-domain, y_k_segments[channel][segment][freq]
+        :param steering_vectors: Steering vectors, steering_vectors[freq][channel]
+        :param channels: Nr. of Channels
+        :return: s_k_estimates[segment][freq]
+        """
+        y_k = np.asarray(y_k_segments[:channels], dtype=COMPLEX_TYPE)
+        weight = 0.25
+        return np.einsum('fc,csf->sf', steering_vectors[:, :channels], y_k) * weight
 
     @staticmethod
     def compute_clean_signal_segment(y_k_segments, segment, steering_vectors, fft_freqs, channels):
@@ -0,0 +1,102 @@
+from timeit import default_timer
+
+import numpy as np
+
+from multi_microphone.music_pra import FREQ_RANGE
+
+CHANGE_THRESHOLD = 0.05
+MAX_AGE = 8  # windows
+BUDGET = 0.05  # of real time
+
+
+class DOATracker(object):
+    """
+    Keeps the steering vector of the speaker up to date, without running MUSIC for every window.
+    For every window, the spatial covariance of the frequencies that MUSIC uses is compared with the one
+    of the last MUSIC run (the change is 1 - their cosine similarity). MUSIC is run again if the steering
+    vector is older than max_age windows, or if the covariance changed by more than the threshold and the
+    MUSIC runs so far used less than the budget (i.e. a fraction of the duration of the processed audio).
+    With max_age=2 and threshold=None, MUSIC is run for every other window (as before the tracker).
+    """
+
+    def __init__(self, music, step_size, threshold=CHANGE_THRESHOLD, max_age=MAX_AGE, budget=BUDGET):
+        """
+        :param music: MUSIC object (see music_pra)
+        :param step_size: Nr. of new samples in every window
+        :param threshold: Min. change of the spatial covariance for a new MUSIC run (None: only when stale)
+        :param max_age: Max. nr. of windows before a new MUSIC run
+        :param budget: Max. fraction of the duration of the audio spent on (change triggered) MUSIC runs
+        """
+        self.music = music
+        self.threshold = threshold
+        self.max_age = max_age
+        self.budget = budget
+        self.window_duration = step_size / float(music.sample_rate)
+
+        # Table of the precomputed steering vectors, steering_vectors[grid point][freq][channel]
+        self.steering_vectors = np.ascontiguousarray(np.moveaxis(music.doa.mode_vec.mode_vec, 2, 0))
+        fft_freqs = np.fft.rfftfreq(music.window_size_frame, 1.0 / music.sample_rate)
+        self.bins = np.flatnonzero((fft_freqs >= FREQ_RANGE[0]) & (fft_freqs <= FREQ_RANGE[1]))
+
+        self.vector = None
+        self.covariance = None
+        self.age = 0
+        self.credit = 0.0  # seconds of MUSIC that the budget allows
+
+        # Statistics
+        self.windows = 0
+        self.updates = 0
+        self.music_time = 0.0
+        self.azimuths = []
+
+    def update(self, signal_window, y_k_segments):
+        """
+        :param signal_window: Signal window, signal_window[sample][channel]
+        :param y_k_segments: Its segments in freq. domain, y_k_segments[channel][segment][freq]
+        :return: The steering vector for the window, vector[freq][channel]
+        """
+        self.windows += 1
+        self.age += 1
+        self.credit = min(self.credit + self.budget * self.window_duration, self.budget * self.window_duration *
+                          self.max_age)
+
+        y_k = np.asarray(y_k_segments)[:, :, self.bins]
+        covariance = np.einsum('csf,dsf->cd', y_k, np.conj(y_k))
+        if self.vector is None or self.age >= self.max_age:
+            self.locate(signal_window, covariance)
+        elif self.threshold is not None and self.credit > 0 and self.get_change(covariance) > self.threshold:
+            self.locate(signal_window, covariance)
+        return self.vector
+
+    def get_change(self, covariance):
+        norms = np.linalg.norm(covariance) * np.linalg.norm(self.covariance)
+        if norms == 0:
+            return 0.0 if np.linalg.norm(covariance) == np.linalg.norm(self.covariance) else 1.0
+        return 1 - np.abs(np.vdot(self.covariance, covariance)) / norms
+
+    def locate(self, signal_window, covariance):
+        start = default_timer()
+        azimuth, _ = self.music.process_chunk(signal_window)
+        duration = default_timer() - start
+
+        self.vector = self.steering_vectors[self.music.doa.src_idx[0]]
+        self.covariance = covariance
+        self.age = 0
+        self.credit -= duration
+        self.updates += 1
+        self.music_time += duration
+        self.azimuths.append(float(azimuth[0]))
+
+    def get_jitter(self):
+        """
+        :return: Standard deviation of the change in azimuth between consecutive MUSIC runs (degrees)
+        """
+        if len(self.azimuths) < 2:
+            return 0.0
+        changes = (np.diff(self.azimuths) + 180) % 360 - 180
+        return float(np.std(changes))
+
+    def __str__(self):
+        return ('DOA updated for %d of %d windows (%.0f%%), MUSIC %.1f ms per update, jitter %.1f degrees'
+                % (self.updates, self.windows, 100.0 * self.updates / max(self.windows, 1),
+                   1000 * self.music_time / max(self.updates, 1), self.get_jitter()))
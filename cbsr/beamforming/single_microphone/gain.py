@@ -1,12 +1,15 @@
 import numpy as np
 
 
-def power_spectral_subtraction(y_k, pyy, pnn, min_=0.2):
+def power_spectral_subtraction(y_k, pyy, pnn, min_=0.2, axis=None):
     """
+    Args:
+        axis: Axes of the mean PSDs, e.g. all but the first for a gain per channel (None: a single gain)
     Returns:
         s_k estimate
     """
-    h_k = np.sqrt(np.maximum(1 - (np.mean(pnn) / np.mean(pyy)), min_))
+    h_k = np.sqrt(np.maximum(1 - (np.mean(pnn, axis=axis, keepdims=True) / np.mean(pyy, axis=axis, keepdims=True)),
+                             min_))
     s_k_magnitude = h_k * np.absolute(y_k)
     return s_k_magnitude * np.exp(1j * np.angle(y_k))
 
@@ -2,6 +2,7 @@ from functools import lru_cache
 from sys import float_info
 
 import numpy as np
+from scipy.ndimage import minimum_filter1d
 
 from tools.utils import exponential_smoothening
 
@@ -55,6 +56,10 @@ def _estimate_variance(pyy, window_size, alpha):
     Estimate noise σ² of a PSD by taking a sliding window and grabbing the minimum
     value.
 
+    Row l of the (l, d) matrix q of _estimate_variance_bias would hold the d - 1 values before bin l
+    (padded with a zero), all first d values for 0 < l < d, and only zeros for l = 0, so its minimum
+    is computed with a sliding minimum over the (elementwise) bias corrected values instead.
+
     Args:
         pyy: Power spectral density
         window_size: Window size
@@ -63,17 +68,18 @@ def _estimate_variance(pyy, window_size, alpha):
     """
     l = pyy.shape[0]
     d = int(l * window_size)
-    q_vec = np.zeros((l, d))
-
-    for l in range(1, l):
-        window_start = max(l - d + 1, 0)
-        window_end = l + max(0, d - l)
-        cur_window_size = window_end - window_start
-        assert cur_window_size > 0
+    assert d > 1
 
-        q_vec[l, 0:cur_window_size] = pyy[window_start:window_end]
+    corrected = _estimate_variance_bias(pyy, d)
+    corrected_zero = _estimate_variance_bias(np.zeros(1), d)[0]
 
-    variance = _estimate_variance_bias(q_vec, d)
+    variance = np.empty_like(corrected)
+    variance[0] = corrected_zero
+    variance[1:d] = np.min(corrected[:d])
+    if l > d:
+        # minimum of corrected[i - d + 2:i + 1] at i, i.e. of the d - 1 values before bin i + 1
+        window_min = minimum_filter1d(corrected, size=d - 1, origin=(d - 2) // 2)
+        variance[d:] = np.minimum(window_min[d - 1:l - 1], corrected_zero)
 
     return exponential_smoothening(variance, alpha)
 
@@ -85,7 +91,7 @@ def _estimate_variance_bias(q, d):
     """
     m_d = m(d)
     q_scaled = (q - 2 * m_d) / (1 - m_d)
-    return np.min(1 + (d - 1) * (2 / q_scaled), axis=1)
+    return 1 + (d - 1) * (2 / q_scaled)
 
 
 @lru_cache(None)
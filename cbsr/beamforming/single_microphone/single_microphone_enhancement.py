@@ -2,13 +2,14 @@ import numpy as np
 
 from single_microphone.gain import wiener_smoother
 from single_microphone.noise_tracking import estimate_noise_psd
-from tools.segmentation import framing, overlap_add
+from tools.segmentation import get_plan
 from tools.utils import estimate_psd
 
 
 class SingleMicrophoneEnhancement(object):
     """
-    Class to perform a single microphone enhancement
+    Class to perform a single microphone enhancement, of a whole signal (enhance_speech_no_stream)
+    or of a continuous signal in chunks of any size (enhance_speech), e.g. from an audio_stream
     """
 
     def __init__(self, window_size_ms=None, window_size_frame=None,
@@ -19,18 +20,72 @@ class SingleMicrophoneEnhancement(object):
         self.psd_window_factor = psd_window_factor
         self.variance_window_factor = variance_window_factor
         self.sample_rate = sample_rate
+        if window_size_frame is not None and window_size_ms is None:
+            samples_per_window = window_size_frame
+        elif window_size_frame is None and window_size_ms is not None:
+            samples_per_window = int(sample_rate * (window_size_ms / 1000.0))
+        else:
+            raise ValueError('Specify window_size_frame XOR window_size_ms, not both or neither')
+        self.plan = get_plan(samples_per_window)
+
+        # Stream state
+        self.pnn_prev = None
+        self.pss_prev = None
+        self.pending = None
+        self.tail = None
 
     def enhance_speech_no_stream(self, signal_window):
-        y_segments = framing(signal_window, self.sample_rate,
-                             window_size_frame=self.window_size_frame,
-                             window_size_ms=self.window_size_ms)
-        y_k_segments = np.fft.fft(y_segments, axis=1)
+        y_k_segments = self.plan.stft(signal_window, onesided=False)
+        s_k_estimates, _, _ = self.enhance_segments(y_k_segments, None, None)
+        s_estimate = self.plan.istft(s_k_estimates, onesided=False)
+        return s_estimate
+
+    def enhance_speech(self, chunk):
+        """
+        Enhance the next chunk of a continuous signal. Noise tracking continues from the previous chunk.
+        :param chunk: Next samples of the signal
+        :return: Enhanced samples (int16) up to the start of the last window that was processed, i.e. delayed by
+        samples_per_window - window_step samples; call flush for the last ones.
+        """
+        chunk = np.asarray(chunk).reshape(-1)
+        pending = chunk if self.pending is None else np.concatenate((self.pending, chunk))
+        if pending.shape[0] < self.plan.samples_per_window:
+            self.pending = pending
+            return np.zeros(0, dtype=np.int16)
+
+        y_k_segments = self.plan.stft(pending, onesided=False)
+        s_k_estimates, self.pnn_prev, self.pss_prev = self.enhance_segments(y_k_segments, self.pnn_prev,
+                                                                            self.pss_prev)
+        s_estimate = self.plan.istft(s_k_estimates, onesided=False)
+
+        # Add the overlapping end of the previous windows, and keep the end of these windows for the next ones
+        if self.tail is not None:
+            s_estimate[:self.tail.shape[0]] += self.tail
+        done = y_k_segments.shape[0] * self.plan.window_step
+        self.tail = s_estimate[done:]
+        self.pending = pending[done:]
+        return s_estimate[:done]
 
+    def flush(self):
+        """
+        End the stream: the noise tracking is reset for the next one
+        :return: The last enhanced samples (int16)
+        """
+        tail = self.tail if self.tail is not None else np.zeros(0, dtype=np.int16)
+        self.pnn_prev = None
+        self.pss_prev = None
+        self.pending = None
+        self.tail = None
+        return tail
+
+    def enhance_segments(self, y_k_segments, pnn_prev, pss_prev):
+        """
+        Enhance the segments in freq. domain one by one, tracking the noise from the given previous estimates
+        :return: s_k_estimates[segment][freq] (band-passed), and the last noise and speech PSD estimates
+        """
         s_k_estimates = np.zeros_like(y_k_segments, dtype=complex)
         num_segments = y_k_segments.shape[0]
 
-        pnn_prev = None
-        pss_prev = None
         for i in range(num_segments):
             y_k = y_k_segments[i]
             pyy = estimate_psd(y_k, window_size=self.psd_window_factor)
@@ -43,9 +98,7 @@ class SingleMicrophoneEnhancement(object):
             pss_prev = estimate_psd(s_k_estimates[i], window_size=0)
 
         s_k_estimates = self.bandpass(s_k_estimates, 300, 3400)
-        s_estimates = np.fft.ifft(s_k_estimates, axis=1)
-        s_estimate = overlap_add(s_estimates)
-        return s_estimate
+        return s_k_estimates, pnn_prev, pss_prev
 
     def bandpass(self, transformed_sig, low_pass=0, high_pass=np.inf):
         """
@@ -55,8 +108,6 @@ class SingleMicrophoneEnhancement(object):
         :param high_pass:
         :return:
         """
-        fft_frequencies = np.fft.fftfreq(self.window_size_frame, 1 / self.sample_rate)
-        for bin_, freq in enumerate(fft_frequencies):
-            if not low_pass < abs(freq) < high_pass:
-                transformed_sig[:, bin_] = 0
+        fft_frequencies = np.abs(np.fft.fftfreq(self.plan.samples_per_window, 1 / self.sample_rate))
+        transformed_sig[:, ~((low_pass < fft_frequencies) & (fft_frequencies < high_pass))] = 0
         return transformed_sig
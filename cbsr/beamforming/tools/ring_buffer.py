@@ -0,0 +1,76 @@
+from threading import Condition
+
+import numpy as np
+
+
+class RingBuffer(object):
+    """
+    Preallocated circular buffer of multichannel samples, from which (overlapping) windows are read as views.
+    Every sample is stored twice, at i and i + capacity, so that any window is contiguous in memory.
+    """
+
+    def __init__(self, capacity, channels, dtype=np.int16):
+        """
+        :param capacity: Max. nr. of samples (per channel) in the buffer; at least the window size
+        :param channels: Nr. of channels
+        :param dtype: Type of the samples
+        """
+        self.capacity = capacity
+        self.data = np.zeros((2 * capacity, channels), dtype=dtype)
+        self.start = 0  # nr. of samples read (i.e. stepped over)
+        self.end = 0  # nr. of samples written
+        self.closed = False
+        self.condition = Condition()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def write(self, samples):
+        """
+        Append samples[sample][channel], blocking while the buffer is full
+        :return: False if the buffer was closed (before all samples could be written)
+        """
+        written = 0
+        while written < samples.shape[0]:
+            with self.condition:
+                while len(self) == self.capacity and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return False
+                count = min(samples.shape[0] - written, self.capacity - len(self))
+                position = self.end % self.capacity
+                first = min(count, self.capacity - position)
+                for offset in (0, self.capacity):
+                    self.data[offset + position:offset + position + first] = samples[written:written + first]
+                    self.data[offset:offset + count - first] = samples[written + first:written + count]
+                self.end += count
+                written += count
+                self.condition.notify_all()
+        return True
+
+    def windows(self, window_size, step_size):
+        """
+        Yield views of window_size samples, every step_size samples, blocking until enough samples were written.
+        A window is valid until the next one is requested. After the buffer is closed, the remaining samples
+        (if any) are yielded as a last, shorter window.
+        """
+        while True:
+            with self.condition:
+                while len(self) < window_size and not self.closed:
+                    self.condition.wait()
+                available = min(len(self), window_size)
+                position = self.start % self.capacity
+            if available < window_size:
+                if available > 0:
+                    yield self.data[position:position + available]
+                return
+
+            yield self.data[position:position + window_size]
+            with self.condition:
+                self.start += step_size
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
@@ -1,4 +1,7 @@
+from functools import lru_cache
+
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 def framing(y, fs, window_size_frame=2 ** 10, window_size_ms=None, overlap=0.5):
@@ -21,27 +24,7 @@ def framing(y, fs, window_size_frame=2 ** 10, window_size_ms=None, overlap=0.5):
         samples_per_window = int(fs * (window_size_ms / 1000.0))
     else:
         raise ValueError('Specify window_size_frame XOR window_size_ms, not both or neither')
-    try:
-        assert y.shape[0] >= samples_per_window
-    except AssertionError:
-        return np.zeros((1, samples_per_window), dtype=y.dtype)
-
-    window = np.hanning(samples_per_window)
-
-    window_start = 0
-    window_end = window_start + samples_per_window
-    window_step = int(samples_per_window * (1.0 - overlap))
-
-    n = y.shape[0]
-    segment_count = int(n / window_step) - 1
-    ys = np.zeros((segment_count, samples_per_window), dtype=y.dtype)
-
-    for s in range(segment_count):
-        ys[s] = y[window_start: window_end] * window
-        window_start += window_step
-        window_end += window_step
-
-    return ys
+    return get_plan(samples_per_window, overlap).framing(y)
 
 
 def overlap_add(ys, overlap=0.5):
@@ -55,18 +38,86 @@ def overlap_add(ys, overlap=0.5):
     Returns:
         combined signal
     """
-    samples_per_window = ys.shape[1]
+    return get_plan(ys.shape[-1], overlap).overlap_add(ys)
 
-    window_start = 0
-    window_end = window_start + samples_per_window
-    window_step = int(samples_per_window * (1.0 - overlap))
 
-    n = int(ys.shape[0] * ys.shape[1] * (1.0 - overlap) + 0.5 * ys.shape[1])
-    y = np.zeros(n, dtype=np.int16)
+@lru_cache(maxsize=16)
+def get_plan(samples_per_window, overlap=0.5):
+    """
+    Get the (shared) SegmentationPlan for the given window size and overlap
+    """
+    return SegmentationPlan(samples_per_window, overlap)
+
 
-    for y_segment in ys:
-        y[window_start: window_end] += y_segment.real.astype(np.int16)
-        window_start += window_step
-        window_end += window_step
+class SegmentationPlan(object):
+    """
+    Framing with a Hanning window and overlap-add for a fixed window size and overlap, for one or more channels.
+    The window is computed once, frames are taken from a strided view of the signal and added back per block
+    of window_step samples. The results equal those of framing and overlap_add, including the truncation of
+    every frame to the type of the signal (framing) or to int16 (overlap_add).
+    """
 
-    return y
+    def __init__(self, samples_per_window, overlap=0.5):
+        """
+        :param samples_per_window: window size (in frames)
+        :param overlap: overlap ratio
+        """
+        self.samples_per_window = samples_per_window
+        self.overlap = overlap
+        self.window = np.hanning(samples_per_window)
+        self.window_step = int(samples_per_window * (1.0 - overlap))
+
+    def framing(self, y):
+        """
+        :param y: signal, y[sample] or y[sample][channel]
+        :return: ys[segment][frame], or ys[channel][segment][frame] for a multichannel signal
+        """
+        channels = y.shape[1:]
+        if y.shape[0] < self.samples_per_window:
+            return np.zeros(channels + (1, self.samples_per_window), dtype=y.dtype)
+
+        segment_count = int(y.shape[0] / self.window_step) - 1
+        # view[segment][channel...][frame]
+        view = sliding_window_view(y, self.samples_per_window, axis=0)[::self.window_step][:segment_count]
+        view = np.moveaxis(view, 0, -2)
+        ys = np.empty(view.shape, dtype=y.dtype)
+        np.multiply(view, self.window, out=ys, casting='unsafe')
+        return ys
+
+    def overlap_add(self, ys):
+        """
+        :param ys: ys[segment][frame], or ys[channel][segment][frame]
+        :return: combined int16 signal, y[sample] or y[sample][channel]
+        """
+        segment_count = ys.shape[-2]
+        n = int(segment_count * self.samples_per_window * (1.0 - self.overlap) + 0.5 * self.samples_per_window)
+        # int16 wraps around, so summing the truncated frames in a wider type and truncating once is equivalent
+        segments = ys.real.astype(np.int16).astype(np.int64)
+        y = np.zeros(ys.shape[:-2] + (n,), dtype=np.int64)
+        if self.samples_per_window % self.window_step == 0:
+            length = segment_count * self.window_step
+            for block in range(self.samples_per_window // self.window_step):
+                start = block * self.window_step
+                block_values = segments[..., start:start + self.window_step]
+                y[..., start:start + length] += block_values.reshape(ys.shape[:-2] + (length,))
+        else:
+            indices = (np.arange(segment_count)[:, None] * self.window_step +
+                       np.arange(self.samples_per_window)[None, :])
+            for channel in np.ndindex(*ys.shape[:-2]):
+                np.add.at(y[channel], indices, segments[channel])
+        return np.moveaxis(y.astype(np.int16), 0, -1)
+
+    def stft(self, y, onesided=True):
+        """
+        :return: fft of the frames (see framing), the positive frequencies only if onesided
+        """
+        ys = self.framing(y)
+        return np.fft.rfft(ys, axis=-1) if onesided else np.fft.fft(ys, axis=-1)
+
+    def istft(self, y_k, onesided=True):
+        """
+        :return: combined signal (see overlap_add) from the fft of the frames
+        """
+        if onesided:
+            return self.overlap_add(np.fft.irfft(y_k, n=self.samples_per_window, axis=-1))
+        return self.overlap_add(np.fft.ifft(y_k, axis=-1))
@@ -1,7 +1,7 @@
 from functools import lru_cache
 
 import numpy as np
-from scipy.linalg import toeplitz
+from scipy.signal import lfilter
 
 
 def estimate_psd(y_k, window_size):
@@ -17,12 +17,10 @@ def estimate_psd(y_k, window_size):
 def exponential_smoothening(x, alpha):
     """
     Apply exponential smoothening:
-    x2(l) = \alpha * x(l-1) + (1 - \alpha) * x(l)
+    x2(l) = \alpha * x2(l-1) + (1 - \alpha) * x(l), with x2(-1) = 0
     """
     n = x.shape[0]
-    res = np.empty_like(x)
-    for l in range(1, n):
-        res[l] = alpha * res[l - 1] + (1 - alpha) * x[l]
+    res = lfilter([1 - alpha], [1, -alpha], x, axis=0)
 
     bias = __get_es_bias(alpha, n)
     return res * bias
@@ -35,22 +33,30 @@ def __get_es_bias(alpha, n):
 
 def bartlett_estimate(x, window_size):
     """
-    Calculate the Bartlett estimate
+    Calculate the Bartlett estimate: the mean of the last m = window_size * l values of x (along its first axis),
+    or of all values so far for the first m - 1.
+    Every window sum is the sum of the end of one block of m values and the start of the next (or of a whole
+    block), so that it takes O(l) and, unlike a cumulative sum over all values, only adds values of the window.
     """
     assert 0 < window_size <= 1
     l = x.shape[0]
-    m = round(l * window_size)
-    return __bartlett_toeplitz(l, m) @ x
-
-
-@lru_cache(None)
-def __bartlett_toeplitz(l, m):
-    c0 = np.zeros(l, dtype=np.bool)
-    c0[0:m] = 1
-
-    r0 = np.zeros(l, dtype=np.bool)
-    r0[0] = 1
-
-    t = toeplitz(c0, r0)
-    t_row_sums = t.sum(axis=1)
-    return t / t_row_sums[:, np.newaxis]
+    m = max(round(l * window_size), 1)
+    block_count = -(-l // m)
+
+    blocks = np.zeros((block_count * m,) + x.shape[1:], dtype=np.result_type(x.dtype, np.float64))
+    blocks[:l] = x
+    blocks = blocks.reshape((block_count, m) + x.shape[1:])
+    starts = np.cumsum(blocks, axis=1).reshape((block_count * m,) + x.shape[1:])
+    ends = np.cumsum(blocks[:, ::-1], axis=1)[:, ::-1].reshape((block_count * m,) + x.shape[1:])
+
+    sums = starts[:l]
+    if l > m:
+        window_starts = np.arange(1, l - m + 1)
+        straddle = (window_starts % m) != 0
+        sums[m:][straddle] += ends[window_starts[straddle]]
+    return sums / __bartlett_counts(l, m).reshape((l,) + (1,) * (x.ndim - 1))
+
+
+@lru_cache(maxsize=32)
+def __bartlett_counts(l, m):
+    return np.minimum(np.arange(1, l + 1), m)
@@ -0,0 +1,67 @@
+from numpy import frombuffer, int16, zeros
+
+BLOCK_TIMEOUT = 1  # seconds
+MAX_CHUNKS = 64
+MIN_SAMPLES = 28  # shorter chunks are corrupt
+
+
+class AudioReader(object):
+    """
+    Reads the chunks of interleaved int16 audio that the robot pushes to an audio list (i.e. audio_stream
+    or audio_stream_multi), see SoundProcessingModule. Waits for the first chunk with BLPOP, so an idle
+    session costs one command per timeout, and then drains the chunks that are still queued behind it
+    (up to max_chunks) with LRANGE and LTRIM in a single transaction.
+    """
+
+    def __init__(self, redis, key, channels, timeout=BLOCK_TIMEOUT, max_chunks=MAX_CHUNKS, min_samples=MIN_SAMPLES):
+        self.redis = redis
+        self.key = key
+        self.channels = channels
+        self.timeout = timeout
+        self.max_chunks = max_chunks
+        self.min_samples = min_samples
+        self.discarded = 0
+
+    def clear(self):
+        self.redis.delete(self.key)
+
+    def read_chunks(self):
+        """
+        :return: the raw chunks that were available, or an empty list if none arrived within the timeout
+        """
+        first = self.redis.blpop([self.key], timeout=self.timeout)
+        if first is None:
+            return []
+        pipe = self.redis.pipeline()
+        pipe.lrange(self.key, 0, self.max_chunks - 2)
+        pipe.ltrim(self.key, self.max_chunks - 1, -1)
+        rest, _ = pipe.execute()
+        return [first[1]] + rest
+
+    def read(self):
+        """
+        :return: the samples of all available chunks as one array[sample][channel],
+        or None if none (valid) arrived within the timeout
+        """
+        return self.parse(self.read_chunks())
+
+    def parse(self, chunks):
+        """
+        Pads every chunk with zeros to whole samples (i.e. a value for every channel), drops the chunks
+        shorter than min_samples, and copies the remaining ones into a single array[sample][channel].
+        """
+        frame_size = 2 * self.channels  # bytes per sample of all channels
+        lengths = [(len(chunk) + frame_size - 1) // frame_size for chunk in chunks]
+        valid = [(chunk, length) for chunk, length in zip(chunks, lengths) if length >= self.min_samples]
+        self.discarded += len(chunks) - len(valid)
+        if not valid:
+            return None
+
+        samples = zeros((sum(length for _, length in valid), self.channels), dtype=int16)
+        flat = samples.reshape(-1)
+        start = 0
+        for chunk, length in valid:
+            values = frombuffer(chunk, dtype=int16, count=len(chunk) // 2)
+            flat[start:start + len(values)] = values
+            start += length * self.channels
+        return samples
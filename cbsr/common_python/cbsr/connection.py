@@ -0,0 +1,100 @@
+from collections import deque
+from threading import Event, Lock, Thread, current_thread
+from time import sleep
+
+from redis import Redis
+
+POLL_TIMEOUT = 0.01  # seconds
+SUBSCRIBE_TIMEOUT = 10  # seconds
+
+
+class CBSRconnection(object):
+    """
+    The Redis connections of a factory (process), shared by all of its services: one ConnectionPool for
+    the commands, and one pubsub connection (polled by a single thread) for the subscriptions of all
+    services, which redis-py dispatches to the handler of each channel.
+    Calling it returns a client on the shared pool, so it can be passed as the connect of a service.
+    As all handlers run on the same thread, they should hand any real work over to another thread; an
+    exception in a handler is only logged, so it cannot stop the delivery to the other services.
+    A PubSub is not thread-safe, so (un)subscribing is only requested by other threads, and done by the
+    polling thread in between its reads (where subscribe waits for, so no message is missed after it returns).
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = Lock()
+        self.requests = deque()
+        self.pubsub = None
+        self.pubsub_thread = None
+        self.running = False
+
+    def __call__(self):
+        return Redis(connection_pool=self.pool)
+
+    def subscribe(self, mapping):
+        """
+        :param mapping: the handler for every channel (see CBSRservice.get_channel_action_mapping)
+        """
+        if not mapping:
+            return
+        guarded = dict((channel, self.guard(channel, handler)) for channel, handler in mapping.items())
+        subscribed = Event()
+        with self.lock:
+            self.requests.append((True, guarded, subscribed))
+            if self.pubsub_thread is None:
+                self.running = True
+                self.pubsub_thread = Thread(target=self.poll)
+                self.pubsub_thread.daemon = True
+                self.pubsub_thread.start()
+            pubsub_thread = self.pubsub_thread
+        if current_thread() is not pubsub_thread:
+            subscribed.wait(SUBSCRIBE_TIMEOUT)
+
+    def unsubscribe(self, channels):
+        if channels:
+            self.requests.append((False, list(channels), Event()))
+
+    @staticmethod
+    def guard(channel, handler):
+        def handle(message):
+            try:
+                handler(message)
+            except Exception as err:
+                print('Handling a message on ' + str(channel) + ' has failed: ' + str(err))
+        return handle
+
+    def poll(self):
+        self.pubsub = self().pubsub(ignore_subscribe_messages=True)
+        subscribed = False
+        while self.running:
+            try:
+                while self.requests:
+                    is_subscribe, channels, done = self.requests[0]
+                    if is_subscribe:
+                        self.pubsub.subscribe(**channels)
+                        subscribed = True
+                    else:
+                        self.pubsub.unsubscribe(*channels)
+                    self.requests.popleft()
+                    done.set()
+                if subscribed:
+                    self.pubsub.get_message(timeout=POLL_TIMEOUT)  # calls the handler of the channel
+                else:
+                    sleep(POLL_TIMEOUT)
+            except Exception as err:
+                if self.running:
+                    print('Receiving the subscribed messages has failed: ' + str(err))
+                    sleep(1)  # the pubsub reconnects (and resubscribes) on the next read
+        self.pubsub.close()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+            pubsub_thread = self.pubsub_thread
+            self.pubsub_thread = None
+        if pubsub_thread is not None:
+            pubsub_thread.join(1)
+
+    def close(self):
+        self.stop()
+        self.pool.disconnect()
@@ -1,25 +1,57 @@
+from multiprocessing import Process, Queue
 from os import getenv
-from signal import pause, signal, SIGTERM, SIGINT
+from signal import pause, signal, SIG_IGN, SIGTERM, SIGINT
 from sys import exit
+from threading import Thread
+from time import gmtime, mktime, sleep, time
+from zlib import crc32
 
-from redis import Redis
+try:
+    from queue import Queue as LocalQueue  # Python 3
+except ImportError:
+    from Queue import Queue as LocalQueue  # Python 2
+
+from redis.connection import ConnectionPool, SSLConnection
+
+from cbsr.connection import CBSRconnection
+from cbsr.metrics import ACTIVE_SESSIONS, LIVENESS_SWEEP_SECONDS, start_metrics_server
 
 
 class CBSRfactory(object):
     def __init__(self):
         self.active = {}
+        self.launching = set()
+        # The services (in this process) are checked for a connected device in a single sweep every minute
+        self.sweep_duration = 0
+        self.running = True
 
-        # Redis initialization
-        self.redis = self.connect()
+        # Run the services as threads in this process, or shard them onto CBSR_WORKERS separate processes
+        # (so that CPU-bound services are not serialized by the GIL); this has to happen before connecting
+        self.workers = []
+        self.disconnected = None
+        self.launches = None
+        # The metrics of this process are exported on METRICS_PORT (and of the workers on the ports after it)
+        self.metrics_port = int(getenv('METRICS_PORT', '0'))
+        worker_count = int(getenv('CBSR_WORKERS', '0'))
+        if worker_count > 0:
+            self.start_workers(worker_count)
+        else:
+            self.prepare()
+        if self.metrics_port:
+            start_metrics_server(self.metrics_port)
+
+        # Redis initialization (the connections are shared with the services that run in this process)
+        self.connection = CBSRconnection(self.create_pool())
+        self.redis = self.connection()
         print('Subscribing...')
-        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
-        self.pubsub.subscribe(**{self.get_connection_channel(): self.start_service})
-        self.pubsub_thread = self.pubsub.run_in_thread(sleep_time=0.001)
+        self.connection.subscribe({self.get_connection_channel(): self.start_service})
+        if not self.workers:
+            self.start_launcher()
+            self.start_liveness_check()
 
         # Register cleanup handlers
         signal(SIGTERM, self.cleanup)
         signal(SIGINT, self.cleanup)
-        self.running = True
 
     def get_connection_channel(self):
         return None  # TO IMPLEMENT
@@ -27,27 +59,193 @@ class CBSRfactory(object):
     def create_service(self, connect, identifier, disconnect):
         return None  # TO IMPLEMENT
 
+    def prepare(self):
+        pass  # TO IMPLEMENT (optional): create anything the services of a process share
+
+    def release(self):
+        pass  # TO IMPLEMENT (optional): clean up whatever prepare created
+
     @staticmethod
-    def connect():
+    def create_pool():
         host = getenv('DB_IP')
         password = getenv('DB_PASS')
         self_signed = getenv('DB_SSL_SELFSIGNED')
         if self_signed == '1':
-            return Redis(host=host, ssl=True, ssl_ca_certs='cert.pem', password=password)
+            return ConnectionPool(connection_class=SSLConnection, host=host, ssl_ca_certs='cert.pem', password=password)
         else:
-            return Redis(host=host, ssl=True, password=password)
+            return ConnectionPool(connection_class=SSLConnection, host=host, password=password)
 
     def start_service(self, message):
         data = message['data'].decode('utf-8')
-        if data in self.active:
+        if data in self.active or data in self.launching:
             print('Reusing already running service for ' + data)
         else:
             print('Launching new service for ' + data)
-            service = self.create_service(self.connect, data, self.disconnect_service)
-            self.active[data] = service
+            if self.workers:
+                # The same identifier always ends up at the same worker process
+                worker = (crc32(data.encode('utf-8')) & 0xffffffff) % len(self.workers)
+                if not self.workers[worker][0].is_alive():
+                    self.restart_worker(worker)
+                self.workers[worker][1].put(data)
+                self.active[data] = worker
+            else:
+                # Creating a service can take a while, which would hold up the messages of all other services
+                self.launching.add(data)
+                self.launches.put(data)
+            self.update_sessions()
 
     def disconnect_service(self, identifier):
-        self.active.pop(identifier)
+        self.active.pop(identifier, None)
+        self.update_sessions()
+
+    def update_sessions(self):
+        ACTIVE_SESSIONS.set(len(self.active) + len(self.launching), (self.get_connection_channel(),))
+
+    def start_launcher(self):
+        self.launches = LocalQueue()
+        launcher_thread = Thread(target=self.launch_services, args=(self.launches, self.disconnect_service))
+        launcher_thread.daemon = True
+        launcher_thread.start()
+
+    def launch_services(self, commands, disconnect):
+        while True:
+            identifier = commands.get()
+            if identifier is None:
+                break
+            if identifier in self.active:
+                continue
+            try:
+                self.active[identifier] = self.create_service(self.connection, identifier, disconnect)
+            except Exception as err:
+                print('Launching the service for ' + identifier + ' has failed: ' + str(err))
+                disconnect(identifier)
+            finally:
+                self.launching.discard(identifier)
+
+    def start_workers(self, count):
+        print('Starting ' + str(count) + ' worker processes...')
+        self.disconnected = Queue()
+        for number in range(count):
+            self.workers.append(self.start_worker(number))
+        disconnected_thread = Thread(target=self.receive_disconnected)
+        disconnected_thread.daemon = True
+        disconnected_thread.start()
+
+    def start_worker(self, number):
+        commands = Queue()
+        worker = Process(target=self.run_worker, args=(number, commands))
+        worker.daemon = True
+        worker.start()
+        return worker, commands
+
+    def restart_worker(self, number):
+        print('Worker process ' + str(number) + ' has died, restarting it...')
+        # The sessions of the dead worker are gone, so they are started again when their devices reconnect
+        for identifier, worker in list(self.active.items()):
+            if worker == number:
+                self.active.pop(identifier, None)
+        self.workers[number] = self.start_worker(number)
+        self.update_sessions()
+
+    def run_worker(self, number, commands):
+        # The signals are handled by the factory process, which stops its workers in cleanup
+        signal(SIGTERM, SIG_IGN)
+        signal(SIGINT, SIG_IGN)
+        if self.metrics_port:
+            start_metrics_server(self.metrics_port + 1 + number)
+        self.connection = CBSRconnection(self.create_pool())
+        self.redis = self.connection()
+        # A worker that replaces a dead one is forked from the factory process later on, so it must not
+        # keep the state of that process (e.g. its active maps the identifiers to worker numbers)
+        self.active = {}
+        self.launching = set()
+        self.workers = []
+        self.launches = None
+        self.prepare()
+        self.start_liveness_check()
+        self.launch_services(commands, self.disconnect_worker_service)
+        self.running = False
+        for identifier, service in list(self.active.items()):
+            try:
+                service.cleanup()
+            except Exception as err:
+                print('Cleaning up ' + identifier + ' has failed: ' + str(err))
+        self.release()
+        self.connection.close()
+
+    def disconnect_worker_service(self, identifier):
+        self.active.pop(identifier, None)
+        self.disconnected.put(identifier)
+
+    def receive_disconnected(self):
+        while True:
+            identifier = self.disconnected.get()
+            if identifier is None:
+                break
+            self.active.pop(identifier, None)
+            self.update_sessions()
+
+    def start_liveness_check(self):
+        liveness_thread = Thread(target=self.check_if_alive)
+        liveness_thread.daemon = True
+        liveness_thread.start()
+
+    def check_if_alive(self):
+        while self.running:
+            sleep(60.1)
+            try:
+                self.sweep()
+            except Exception as err:
+                print('Checking the connected devices has failed: ' + str(err))
+
+    def sweep(self):
+        """
+        Shut down every service of which none of the devices has been seen in the last minute,
+        with a single pipeline for the devices of all services (see CBSRservice.get_devices).
+        A service of which the devices cannot be determined is shut down as well.
+        """
+        start = time()
+        services = list(self.active.items())
+        service_devices = []
+        expired = []
+        for identifier, service in services:
+            try:
+                service_devices.append((identifier, service) + tuple(service.get_devices()))
+            except Exception as err:
+                print('Determining the devices of ' + identifier + ' has failed: ' + str(err))
+                expired.append((identifier, service))
+        devices = {}
+        for _, _, user, members in service_devices:
+            for member in members:
+                devices[(user, member)] = None
+        pipe = self.redis.pipeline(transaction=False)
+        for user, member in devices:
+            pipe.zscore(user, member)
+        for device, score in zip(list(devices.keys()), pipe.execute()):
+            devices[device] = score
+
+        one_minute = mktime(gmtime()) - 60
+        for identifier, service, user, members in service_devices:
+            scores = [devices[(user, member)] for member in members]
+            if not any(score is not None and score >= one_minute for score in scores):
+                expired.append((identifier, service))
+        self.sweep_duration = time() - start
+        LIVENESS_SWEEP_SECONDS.set(self.sweep_duration, (self.get_connection_channel(),))
+        print('Checked %d services in %.1f ms (%d expired)' % (len(services), self.sweep_duration * 1000, len(expired)))
+        disconnect = self.disconnect_worker_service if self.disconnected is not None else self.disconnect_service
+        for identifier, service in expired:
+            try:
+                service.shutdown()
+            except Exception as err:
+                print('Shutting down ' + identifier + ' has failed: ' + str(err))
+                disconnect(identifier)
+
+    def stop_workers(self):
+        for _, commands in self.workers:
+            commands.put(None)
+        for worker, _ in self.workers:
+            worker.join(10)
+        self.disconnected.put(None)
 
     def run(self):
         while self.running:
@@ -57,10 +255,14 @@ class CBSRfactory(object):
         self.running = False
         print('Trying to exit gracefully...')
         try:
-            self.pubsub_thread.stop()
-            self.redis.close()
-            for service in self.active.values():
-                service.cleanup()
+            if self.workers:
+                self.stop_workers()
+            else:
+                self.launches.put(None)
+                for service in list(self.active.values()):
+                    service.cleanup()
+                self.release()
+            self.connection.close()
             print('Graceful exit was successful')
         except Exception as err:
             print('Graceful exit has failed: ' + err.message)
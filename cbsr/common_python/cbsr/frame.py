@@ -0,0 +1,273 @@
+from os import getenv
+from threading import Thread
+from time import sleep
+
+from cv2 import cvtColor, imdecode, COLOR_BGR2RGB, COLOR_GRAY2BGR, COLOR_GRAY2RGB, COLOR_RGB2BGR, COLOR_RGB2GRAY, \
+    COLOR_YUV2BGR_YUYV, COLOR_YUV2GRAY_YUYV, COLOR_YUV2RGB_YUYV, IMREAD_COLOR, IMREAD_GRAYSCALE
+from numpy import empty, frombuffer, uint8
+
+from cbsr.frame_ring import FrameRingReader, get_ring_path
+from cbsr.trace import now_millis, TraceContext
+
+DISTRIBUTION_CHANNEL = 'frame_distribution'
+FRAME_STREAM = 'image_frames'
+TWELVE_HOURS = 60 * 60 * 12
+
+OUTPUT_CHANNELS = {'rgb': 3, 'bgr': 3, 'gray': 1}
+YUV_CONVERSIONS = {'rgb': COLOR_YUV2RGB_YUYV, 'bgr': COLOR_YUV2BGR_YUYV, 'gray': COLOR_YUV2GRAY_YUYV}
+RGB_CONVERSIONS = {'bgr': COLOR_RGB2BGR, 'gray': COLOR_RGB2GRAY}
+GRAY_CONVERSIONS = {'rgb': COLOR_GRAY2RGB, 'bgr': COLOR_GRAY2BGR}
+
+
+class FrameDecoder(object):
+    """
+    Decodes the frames of an image_stream into RGB, BGR or grayscale arrays. Besides YUV422 and RGB,
+    the device can send grayscale (Y) or JPEG compressed frames, see VideoProcessingModule.
+    One output buffer is kept per resolution, so the array returned by decode is
+    overwritten by the next call; copy it if it has to outlive the current frame.
+    """
+
+    def __init__(self, output='rgb'):
+        if output not in OUTPUT_CHANNELS:
+            raise ValueError('Unknown output format: ' + output)
+        self.output = output
+        self.width = 0
+        self.height = 0
+        self.color_space = None
+        self.image_size = None
+        self.buffers = {}
+
+    def has_image_size(self):
+        return self.width > 0 and self.height > 0
+
+    def set_image_size(self, image_size):
+        """
+        :param image_size: contents of the image_size key, i.e. 'width height color_space'
+        """
+        if image_size is None:
+            return
+        if not isinstance(image_size, str):
+            image_size = image_size.decode('utf-8')
+        if image_size == self.image_size:
+            return
+        self.image_size = image_size
+        image_size = image_size.split()
+        self.width = int(image_size[0])
+        self.height = int(image_size[1])
+        self.color_space = image_size[2]
+
+    def get_buffer(self):
+        key = (self.width, self.height, self.output)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            channels = OUTPUT_CHANNELS[self.output]
+            shape = (self.height, self.width) if channels == 1 else (self.height, self.width, channels)
+            buffer = empty(shape, dtype=uint8)
+            self.buffers[key] = buffer
+        return buffer
+
+    def decode(self, image_stream):
+        """
+        :return: the decoded frame, or None if the color space is not supported (or not known yet)
+        :raises ValueError: if the frame cannot be decoded (e.g. a corrupt JPEG or a frame of another size)
+        """
+        if self.color_space == 'YUV':
+            # YUV422 is packed as Y0 U Y1 V, i.e. two bytes per pixel
+            yuv = frombuffer(image_stream, dtype=uint8).reshape((self.height, self.width, 2))
+            return cvtColor(yuv, YUV_CONVERSIONS[self.output], self.get_buffer())
+        elif self.color_space == 'RGB':
+            return self.convert(frombuffer(image_stream, dtype=uint8).reshape((self.height, self.width, 3)))
+        elif self.color_space == 'Y':
+            gray = frombuffer(image_stream, dtype=uint8).reshape((self.height, self.width))
+            if self.output == 'gray':
+                return gray  # no conversion needed at all
+            return cvtColor(gray, GRAY_CONVERSIONS[self.output], self.get_buffer())
+        elif self.color_space == 'JPEG':
+            jpeg = frombuffer(image_stream, dtype=uint8)
+            image = imdecode(jpeg, IMREAD_GRAYSCALE if self.output == 'gray' else IMREAD_COLOR)
+            if image is None:
+                raise ValueError('invalid JPEG data (%d bytes)' % len(image_stream))
+            if self.output == 'gray':
+                return image
+            bgr = image
+            if self.output == 'bgr':
+                return bgr
+            return cvtColor(bgr, COLOR_BGR2RGB, self.get_buffer())
+        else:
+            return None
+
+    def convert(self, rgb):
+        """
+        :param rgb: an already decoded RGB frame (of the current image size)
+        :return: the frame in the output format of this decoder
+        """
+        if self.output == 'rgb':
+            return rgb  # no conversion needed at all
+        return cvtColor(rgb, RGB_CONVERSIONS[self.output], self.get_buffer())
+
+
+def decode_frame(decoder, service, image_stream):
+    """
+    :return: the frame decoded by the decoder, or None (after reporting why) if it could not be decoded
+    """
+    if image_stream is None:
+        print(service.identifier + ': no frame available')
+        return None
+    with service.measure('decode'):
+        try:
+            image = decoder.decode(image_stream)
+        except ValueError as err:
+            print(service.identifier + ': decoding a frame has failed: ' + str(err))
+            return None
+    if image is None:
+        print(service.identifier + ': unknown color space: %s' % decoder.color_space)
+    return image
+
+
+class RedisFrameSource(object):
+    """
+    Fetches the raw frame from Redis on every image_available notification and decodes it locally.
+    """
+
+    def __init__(self, output):
+        self.decoder = FrameDecoder(output)
+        self.seq = 0  # the device does not number these frames, so they are numbered on arrival
+        self.timestamp = 0
+        self.trace = None
+
+    def get_channel_action_mapping(self, service, on_frame):
+        def on_image_available(message):
+            self.seq += 1
+            self.timestamp = int(message['data'])
+            on_frame(self.timestamp)
+        return {service.get_full_channel('image_available'): on_image_available}
+
+    def start(self, service):
+        request_frame_format(service)
+
+    def fetch(self, service):
+        # The image size is fetched along with every frame, as the device can change its format when it restarts
+        with service.measure('fetch'):
+            pipe = service.redis.pipeline()
+            pipe.get(service.get_full_channel('image_stream'))
+            pipe.get(service.get_full_channel('image_size'))
+            image_stream, image_size = pipe.execute()
+        self.trace = TraceContext(self.seq, self.timestamp, now_millis())
+        self.decoder.set_image_size(image_size)
+
+        return decode_frame(self.decoder, service, image_stream)
+
+
+class StreamFrameSource(object):
+    """
+    Receives every frame including its bytes from the Redis stream that the device writes to
+    when the image_transport is 'stream', instead of a notification followed by a separate GET.
+    """
+
+    def __init__(self, output):
+        self.decoder = FrameDecoder(output)
+        self.on_frame = None
+        self.latest = (None, 0, None, 0)
+        self.timestamp = 0
+        self.trace = None
+
+    def get_channel_action_mapping(self, service, on_frame):
+        self.on_frame = on_frame
+        return {}  # the frames are read by the receiving thread instead
+
+    def start(self, service):
+        # Ask the device to write its frames into the stream (see VideoProcessingModule)
+        service.redis.setex(service.get_full_channel('image_transport'), TWELVE_HOURS, 'stream')
+        request_frame_format(service)
+        receiving_thread = Thread(target=self.receive, args=(service,))
+        receiving_thread.start()
+
+    def receive(self, service):
+        last_id = '$'
+        reported = (0, 0)
+        while service.running:
+            try:
+                entry = service.read_stream(FRAME_STREAM, last_id)
+            except Exception as err:
+                if service.running:
+                    print(service.identifier + ': reading the frame stream failed: ' + str(err))
+                    sleep(1)
+                continue
+            if entry is None:  # idle, so a good moment to report on the previous frames (if any)
+                counts = (service.stream_received.get(FRAME_STREAM, 0), service.stream_dropped.get(FRAME_STREAM, 0))
+                if counts != reported:
+                    print(service.identifier + ': received %d frames, dropped %d frames' % counts)
+                    reported = counts
+                continue
+            last_id, fields = entry
+            self.latest = (fields[b'image'], int(fields[b'time']), fields[b'size'], int(fields[b'seq']))
+            self.on_frame(self.latest[1])
+
+    def fetch(self, service):
+        image_stream, self.timestamp, image_size, seq = self.latest
+        self.trace = TraceContext(seq, self.timestamp, now_millis())
+        self.decoder.set_image_size(image_size)
+
+        return decode_frame(self.decoder, service, image_stream)
+
+
+class RingFrameSource(object):
+    """
+    Reads the frames that the frame distribution service on this host already fetched and decoded,
+    so a frame is only transferred and decoded once no matter how many vision services use it.
+    """
+
+    def __init__(self, output, directory):
+        self.decoder = FrameDecoder(output)
+        self.directory = directory
+        self.reader = None
+        self.timestamp = 0
+        self.trace = None
+
+    def get_channel_action_mapping(self, service, on_frame):
+        def on_frame_available(message):
+            on_frame(int(message['data'].split(b';')[1]))  # 'seq;timestamp'
+        return {service.get_full_channel('frame_available'): on_frame_available}
+
+    def start(self, service):
+        self.reader = FrameRingReader(get_ring_path(self.directory, service.identifier))
+        # Make sure the distribution service is running for this device (it is reused if it already is)
+        service.redis.publish(DISTRIBUTION_CHANNEL, service.identifier)
+
+    def fetch(self, service):
+        with service.measure('fetch'):
+            frame = self.reader.read()
+        if frame is None:
+            return None
+        self.timestamp = frame.timestamp
+        self.trace = TraceContext(frame.seq, frame.timestamp, now_millis())
+        self.decoder.height, self.decoder.width = frame.image.shape[:2]
+        with service.measure('decode'):
+            return self.decoder.convert(frame.image)
+
+
+def request_frame_format(service):
+    """
+    Ask the device to send its frames in the FRAME_FORMAT (if set), e.g. 'jpeg:80', 'gray' or 'small+gray'.
+    """
+    frame_format = getenv('FRAME_FORMAT')
+    if frame_format:
+        service.redis.setex(service.get_full_channel('image_format'), TWELVE_HOURS, frame_format)
+
+
+def create_frame_source(output, shared=True):
+    """
+    Use the shared memory frames of the frame distribution service if FRAME_RING_DIR is set (and shared),
+    or get every frame from Redis and decode it locally otherwise: either from the frame stream if
+    FRAME_TRANSPORT is 'stream', or by a GET after every image_available notification.
+    The fetched frames always carry the (millisecond) timestamp at which they were produced, which is
+    also passed to the on_frame callback of every source (e.g. FrameSlot.put) when a frame is announced,
+    and the trace of the last fetched frame (see cbsr.trace) can be passed along with its results.
+    """
+    directory = getenv('FRAME_RING_DIR')
+    if shared and directory:
+        return RingFrameSource(output, directory)
+    elif getenv('FRAME_TRANSPORT') == 'stream':
+        return StreamFrameSource(output)
+    else:
+        return RedisFrameSource(output)
@@ -0,0 +1,149 @@
+from collections import namedtuple
+from mmap import mmap, ACCESS_READ
+from os import fstat, rename, stat
+from os.path import join
+from struct import calcsize, pack_into, unpack_from
+
+from numpy import empty, ndarray, uint8
+
+MAGIC = b'CBFR'
+HEADER = '<4sIII'  # magic, version, slot count, slot size
+SLOT_HEADER = '<QQIII'  # sequence number, timestamp (ms), width, height, channels
+VERSION = 1
+HEADER_SIZE = calcsize(HEADER)
+SLOT_HEADER_SIZE = calcsize(SLOT_HEADER)
+DEFAULT_SLOTS = 4
+DEFAULT_SLOT_SIZE = 1280 * 480 * 3  # the largest camera resolution in RGB
+
+Frame = namedtuple('Frame', ['seq', 'timestamp', 'image'])
+
+
+def get_ring_path(directory, identifier):
+    return join(directory, identifier + '.ring')
+
+
+class FrameRingWriter(object):
+    """
+    Publishes decoded frames into a memory-mapped ring file that readers on the same host can map.
+    Every slot is guarded by its sequence number: it is zeroed while the slot is being written,
+    so a reader can detect (and skip) a frame that was overwritten while it was copying it.
+    """
+
+    def __init__(self, path, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE):
+        self.path = path
+        self.slots = slots
+        self.seq = 0
+        self.file = None
+        self.mm = None
+        self.slot_size = 0
+        self.allocate(slot_size)
+
+    def allocate(self, slot_size):
+        self.close()
+        self.slot_size = slot_size
+        # Build the new ring next to the old one, so readers never map a half-initialised file
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as ring_file:
+            ring_file.truncate(HEADER_SIZE + self.slots * (SLOT_HEADER_SIZE + slot_size))
+        rename(tmp_path, self.path)
+        self.file = open(self.path, 'r+b')
+        self.mm = mmap(self.file.fileno(), 0)
+        pack_into(HEADER, self.mm, 0, MAGIC, VERSION, self.slots, slot_size)
+
+    def write(self, image, timestamp):
+        """
+        :param image: uint8 array of shape (height, width) or (height, width, channels)
+        :param timestamp: producer timestamp in milliseconds
+        :return: the sequence number assigned to the frame
+        """
+        height, width = image.shape[:2]
+        channels = image.shape[2] if image.ndim == 3 else 1
+        if image.nbytes > self.slot_size:
+            self.allocate(image.nbytes)
+
+        self.seq += 1
+        offset = HEADER_SIZE + ((self.seq - 1) % self.slots) * (SLOT_HEADER_SIZE + self.slot_size)
+        pack_into(SLOT_HEADER, self.mm, offset, 0, 0, 0, 0, 0)
+        ndarray(image.shape, dtype=uint8, buffer=self.mm, offset=offset + SLOT_HEADER_SIZE)[...] = image
+        pack_into(SLOT_HEADER, self.mm, offset, self.seq, int(timestamp), width, height, channels)
+        return self.seq
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class FrameRingReader(object):
+    """
+    Reads frames from a ring file written by a FrameRingWriter (possibly in another process).
+    Frames are copied into a buffer owned by the reader, which is overwritten by the next read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.mm = None
+        self.slots = 0
+        self.slot_size = 0
+        self.buffers = {}
+
+    def open(self):
+        self.close()
+        try:
+            self.file = open(self.path, 'rb')
+        except IOError:
+            return False
+        self.mm = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        magic, version, self.slots, self.slot_size = unpack_from(HEADER, self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            return False
+        return True
+
+    def is_stale(self):
+        # The writer replaces the file (e.g. on a resolution change), so compare inodes
+        try:
+            return stat(self.path).st_ino != fstat(self.file.fileno()).st_ino
+        except OSError:
+            return True
+
+    def read(self, seq=None):
+        """
+        :param seq: the sequence number of the wanted frame, or None for the most recent frame
+        :return: a Frame, or None if no (consistent) frame is available
+        """
+        if (self.mm is None or self.is_stale()) and not self.open():
+            return None
+
+        if seq is None:
+            offsets = [HEADER_SIZE + slot * (SLOT_HEADER_SIZE + self.slot_size) for slot in range(self.slots)]
+            seq, offset = max((unpack_from('<Q', self.mm, offset)[0], offset) for offset in offsets)
+            if seq == 0:
+                return None
+        else:
+            offset = HEADER_SIZE + ((seq - 1) % self.slots) * (SLOT_HEADER_SIZE + self.slot_size)
+
+        slot_seq, timestamp, width, height, channels = unpack_from(SLOT_HEADER, self.mm, offset)
+        if slot_seq != seq:
+            return None
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        image = self.buffers.get(shape)
+        if image is None:
+            image = empty(shape, dtype=uint8)
+            self.buffers[shape] = image
+        image[...] = ndarray(shape, dtype=uint8, buffer=self.mm, offset=offset + SLOT_HEADER_SIZE)
+        if unpack_from('<Q', self.mm, offset)[0] != seq:
+            return None  # overwritten while copying
+        return Frame(seq, timestamp, image)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,153 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread
+from timeit import default_timer
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(object):
+    """
+    A metric with a value per combination of label values, in the Prometheus text format.
+    """
+
+    def __init__(self, name, documentation, kind, label_names):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.label_names = label_names
+        self.values = {}
+        self.lock = Lock()
+
+    def format_labels(self, label_values, extra=''):
+        labels = ['%s="%s"' % (name, value) for name, value in zip(self.label_names, label_values)]
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    def expose(self):
+        lines = ['# HELP ' + self.name + ' ' + self.documentation, '# TYPE ' + self.name + ' ' + self.kind]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(self.name + self.format_labels(label_values) + ' ' + repr(float(value)))
+        return lines
+
+
+class Counter(Metric):
+    def __init__(self, name, documentation, label_names=()):
+        super(Counter, self).__init__(name, documentation, 'counter', label_names)
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    def __init__(self, name, documentation, label_names=()):
+        super(Gauge, self).__init__(name, documentation, 'gauge', label_names)
+
+    def set(self, value, label_values=()):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, 'histogram', label_names)
+        self.buckets = buckets
+
+    def observe(self, value, label_values=()):
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # The count per bucket (the last one is +Inf) and the sum of all observations
+                counts = [0] * (len(self.buckets) + 1) + [0.0]
+                self.values[label_values] = counts
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, label_values=()):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.observe(default_timer() - start, label_values)
+
+    def expose(self):
+        lines = ['# HELP ' + self.name + ' ' + self.documentation, '# TYPE ' + self.name + ' ' + self.kind]
+        with self.lock:
+            for label_values, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ['+Inf'], counts[:-1]):
+                    cumulative += count
+                    lines.append(self.name + '_bucket' + self.format_labels(label_values, 'le="%s"' % bound) +
+                                 ' ' + str(cumulative))
+                lines.append(self.name + '_sum' + self.format_labels(label_values) + ' ' + repr(counts[-1]))
+                lines.append(self.name + '_count' + self.format_labels(label_values) + ' ' + str(cumulative))
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+# The metrics of all services and factories; the service label is the class name of the service
+FRAMES_RECEIVED = REGISTRY.register(Counter('cbsr_frames_received_total', 'Frames announced to a service',
+                                            ('service',)))
+FRAMES_PROCESSED = REGISTRY.register(Counter('cbsr_frames_processed_total', 'Frames taken for processing',
+                                             ('service',)))
+FRAMES_SKIPPED = REGISTRY.register(Counter('cbsr_frames_skipped_total', 'Frames replaced by a newer frame',
+                                           ('service',)))
+FRAMES_STALE = REGISTRY.register(Counter('cbsr_frames_stale_total', 'Frames dropped for being too old',
+                                         ('service',)))
+STAGE_SECONDS = REGISTRY.register(Histogram('cbsr_stage_seconds', 'Duration of a processing stage',
+                                            ('service', 'stage')))
+QUEUE_DEPTH = REGISTRY.register(Gauge('cbsr_queue_depth', 'Items waiting to be processed', ('queue',)))
+ACTIVE_SESSIONS = REGISTRY.register(Gauge('cbsr_active_sessions', 'Sessions (services) that are running',
+                                          ('factory',)))
+LIVENESS_SWEEP_SECONDS = REGISTRY.register(Gauge('cbsr_liveness_sweep_seconds',
+                                                 'Duration of the last check of all connected devices', ('factory',)))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no line for every scrape
+
+
+def start_metrics_server(port):
+    """
+    Export the metrics of this process in the Prometheus text format on the given (local) port.
+    """
+    server = HTTPServer(('', port), MetricsHandler)
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    print('Exporting metrics on port ' + str(port))
+    return server
@@ -1,23 +1,103 @@
-from threading import Thread
-from time import gmtime, mktime, sleep
+from os import getenv
+from threading import Condition, Thread
+from time import gmtime, mktime, sleep, time
+
+from cbsr.connection import CBSRconnection
+from cbsr.metrics import FRAMES_PROCESSED, FRAMES_RECEIVED, FRAMES_SKIPPED, FRAMES_STALE, STAGE_SECONDS
+from cbsr.trace import append_trace, TRACE_ENABLED
+
+
+class FrameSlot(object):
+    """
+    Holds the producer's timestamp (in ms) of the latest frame that was announced for a session, so a
+    slow detector always continues with the most recent frame: an announcement that was not taken yet
+    is replaced by a newer one (skipped), and a frame that is older than max_age ms by the time it is
+    taken is dropped (stale). A max_age of 0 disables the age check; it defaults to FRAME_MAX_AGE_MS.
+    The counts are also added to the frame metrics of the given service (e.g. its class name).
+    """
+
+    def __init__(self, service='', max_age=None):
+        self.labels = (service,)
+        self.max_age = int(getenv('FRAME_MAX_AGE_MS', '0')) if max_age is None else max_age
+        self.condition = Condition()
+        self.timestamp = None
+        self.closed = False
+        self.processed = 0
+        self.skipped = 0
+        self.stale = 0
+
+    def put(self, timestamp):
+        FRAMES_RECEIVED.inc(self.labels)
+        with self.condition:
+            if self.timestamp is not None:
+                self.skipped += 1
+                FRAMES_SKIPPED.inc(self.labels)
+            self.timestamp = timestamp
+            self.condition.notify()
+
+    def take(self):
+        """
+        Blocks until a frame that is recent enough has been announced.
+        :return: the timestamp of that frame, or None if the slot was closed
+        """
+        with self.condition:
+            while True:
+                while self.timestamp is None and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return None
+                timestamp = self.timestamp
+                self.timestamp = None
+                if self.max_age and int(time() * 1000) - timestamp > self.max_age:
+                    self.stale += 1
+                    FRAMES_STALE.inc(self.labels)
+                    continue
+                self.processed += 1
+                FRAMES_PROCESSED.inc(self.labels)
+                return timestamp
+
+    def open(self):
+        with self.condition:
+            self.timestamp = None
+            self.closed = False
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __str__(self):
+        return 'processed %d, skipped %d and dropped %d stale frames' % (self.processed, self.skipped, self.stale)
 
 
 class CBSRservice(object):
     def __init__(self, connect, identifier, disconnect):
         self.redis = connect()
+        # The subscriptions go through the shared pubsub connection of the factory if it has one
+        self.shared_connection = connect if isinstance(connect, CBSRconnection) else None
         self.identifier = identifier
         self.disconnect = disconnect
         self.running = True
+        # Statistics of the streams that are read (see read_stream)
+        self.stream_seqs = {}
+        self.stream_received = {}
+        self.stream_dropped = {}
 
         # Redis initialization
         print('Subscribing ' + identifier)
-        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
-        self.pubsub.subscribe(**self.get_channel_action_mapping())
-        self.pubsub_thread = self.pubsub.run_in_thread(sleep_time=0.001)
+        mapping = self.get_channel_action_mapping()
+        self.channels = list(mapping.keys())
+        if self.shared_connection:
+            self.shared_connection.subscribe(mapping)
+        else:
+            self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(**mapping)
+            self.pubsub_thread = self.pubsub.run_in_thread(sleep_time=0.001)
 
-        # Ensure we'll shutdown at some point again
-        check_if_alive = Thread(target=self.check_if_alive)
-        check_if_alive.start()
+        # Ensure we'll shutdown at some point again (a factory checks all of its services at once instead)
+        if not self.shared_connection:
+            check_if_alive = Thread(target=self.check_if_alive)
+            check_if_alive.start()
 
     def get_device_types(self):
         return []  # TO IMPLEMENT
@@ -31,18 +111,28 @@ class CBSRservice(object):
     def get_full_channel(self, channel_name):
         return self.identifier + '_' + channel_name
 
+    def measure(self, stage):
+        """
+        Time a processing stage of this service (e.g. fetch, decode, detect or publish), as in:
+        with self.measure('detect'): ...
+        """
+        return STAGE_SECONDS.time((self.__class__.__name__, stage))
+
     def get_user_id(self):
         return self.identifier.split('-')[0]
 
     def get_device_id(self):
         return self.identifier.split('-')[1]
 
-    def check_if_alive(self):
-        user = 'user:' + self.get_user_id()
+    def get_devices(self):
+        """
+        :return: the key of the user and the members of that key for the devices this service depends on
+        """
         device_id = self.get_device_id()
-        devices = []
-        for device_type in self.get_device_types():
-            devices.append(device_id + ':' + device_type)
+        return 'user:' + self.get_user_id(), [device_id + ':' + device_type for device_type in self.get_device_types()]
+
+    def check_if_alive(self):
+        user, devices = self.get_devices()
         while True:
             try:
                 pipe = self.redis.pipeline()
@@ -62,20 +152,53 @@ class CBSRservice(object):
             self.shutdown()
             break
 
-    def publish(self, channel, data):
-        self.redis.publish(self.get_full_channel(channel), data)
+    def read_stream(self, channel, last_id, timeout=1000):
+        """
+        Blocking read of the entry after last_id in a stream that a device produces (see CBSRdevice.produce_stream).
+        Such a stream only keeps its latest entries, so any entries that were skipped or trimmed before they could
+        be read are counted (by their sequence numbers) in stream_dropped.
+        :return: (entry_id, fields), or None if nothing arrived within the timeout (in ms)
+        """
+        result = self.redis.xread({self.get_full_channel(channel): last_id}, count=1, block=timeout)
+        if not result:
+            return None
+        entry_id, fields = result[0][1][-1]
+
+        seq = int(fields[b'seq'])
+        last_seq = self.stream_seqs.get(channel)
+        if last_seq is not None and last_seq < seq:  # the sequence restarts if the device restarts
+            self.stream_dropped[channel] = self.stream_dropped.get(channel, 0) + seq - last_seq - 1
+        self.stream_seqs[channel] = seq
+        self.stream_received[channel] = self.stream_received.get(channel, 0) + 1
+        return entry_id, fields
+
+    def publish(self, channel, data, trace=None):
+        """
+        :param trace: the TraceContext of the frame the data was derived from (if any), which is appended
+                      to the data if CBSR_TRACE is set (see cbsr.trace)
+        """
+        if trace is not None and TRACE_ENABLED:
+            data = append_trace(data, trace)
+        with self.measure('publish'):
+            self.redis.publish(self.get_full_channel(channel), data)
 
     def produce_event(self, event):
         self.publish('events', event)
 
     def shutdown(self):
-        self.cleanup()
-        self.running = False
         print('Trying to exit gracefully...')
         try:
-            self.pubsub_thread.stop()
+            self.cleanup()
+        except Exception as err:
+            print('Cleaning up ' + self.identifier + ' has failed: ' + str(err))
+        self.running = False
+        try:
+            if self.shared_connection:
+                self.shared_connection.unsubscribe(self.channels)
+            else:
+                self.pubsub_thread.stop()
             self.redis.close()
             print('Graceful exit was successful')
         except Exception as err:
-            print('Graceful exit has failed: ' + err.message)
+            print('Graceful exit has failed: ' + str(err))
         self.disconnect(self.identifier)
@@ -0,0 +1,41 @@
+from collections import namedtuple
+from os import getenv
+from time import time
+
+# Only if CBSR_TRACE is set, the trace of a frame is appended to the results that were derived from it
+TRACE_ENABLED = getenv('CBSR_TRACE') == '1'
+TRACE_SEPARATOR = '|'
+
+
+def now_millis():
+    return int(time() * 1000)
+
+
+class TraceContext(namedtuple('TraceContext', 'seq produced received')):
+    """
+    The sequence number and the producer (i.e. robot) timestamp of a frame, plus the time at which
+    a service fetched it; all times are in milliseconds since the epoch.
+    """
+
+    def format(self, published):
+        return '%d;%d;%d;%d' % (self.seq, self.produced, self.received, published)
+
+
+def append_trace(data, trace):
+    """
+    :return: the data with 'seq;produced;received;published' appended after a TRACE_SEPARATOR
+    """
+    return str(data) + TRACE_SEPARATOR + trace.format(now_millis())
+
+
+def split_trace(data):
+    """
+    :return: the original data and the (seq, produced, received, published) of its trace, or None if it has none
+    """
+    data, separator, trace = data.rpartition(TRACE_SEPARATOR)
+    if not separator:
+        return trace, None
+    fields = trace.split(';')
+    if len(fields) != 4 or not all(field.isdigit() for field in fields):
+        return data + separator + trace, None
+    return data, tuple(int(field) for field in fields)
@@ -0,0 +1,179 @@
+from asyncio import Event, get_event_loop, run, wait_for
+from asyncio import TimeoutError as AsyncTimeoutError
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from signal import SIGINT, SIGTERM
+from time import gmtime, mktime, time
+
+from redis.asyncio import Redis
+from redis.asyncio.connection import ConnectionPool, SSLConnection
+
+from cbsr.metrics import ACTIVE_SESSIONS, LIVENESS_SWEEP_SECONDS, start_metrics_server
+
+
+class CBSRasyncFactory(object):
+    """
+    The asyncio variant of CBSRfactory (Python 3 with redis-py 4.2+ only): all services of the factory
+    share one event loop, one connection pool and one pubsub connection, so an idle session costs no
+    thread at all. The messages are dispatched in order, and the blocking work of the services is run
+    in a single executor of CBSR_EXECUTOR_WORKERS threads (see CBSRasyncService.run_in_executor).
+    """
+
+    def __init__(self):
+        self.active = {}
+        self.handlers = {}
+        self.redis = None
+        self.pubsub = None
+        self.stopping = None
+        # The services are checked for a connected device in a single sweep every minute
+        self.sweep_duration = 0
+        self.executor = ThreadPoolExecutor(max_workers=int(getenv('CBSR_EXECUTOR_WORKERS', '4')))
+        self.metrics_port = int(getenv('METRICS_PORT', '0'))
+
+    def get_connection_channel(self):
+        return None  # TO IMPLEMENT
+
+    def create_service(self, identifier):
+        return None  # TO IMPLEMENT: a CBSRasyncService for the given identifier
+
+    @staticmethod
+    def create_pool():
+        host = getenv('DB_IP')
+        password = getenv('DB_PASS')
+        self_signed = getenv('DB_SSL_SELFSIGNED')
+        if self_signed == '1':
+            return ConnectionPool(connection_class=SSLConnection, host=host, ssl_ca_certs='cert.pem', password=password)
+        else:
+            return ConnectionPool(connection_class=SSLConnection, host=host, password=password)
+
+    async def subscribe(self, mapping):
+        self.handlers.update(mapping)
+        if mapping:
+            await self.pubsub.subscribe(*mapping.keys())
+
+    async def unsubscribe(self, channels):
+        for channel in channels:
+            self.handlers.pop(channel, None)
+        if channels:
+            await self.pubsub.unsubscribe(*channels)
+
+    async def start_service(self, message):
+        data = message['data'].decode('utf-8')
+        if data in self.active:
+            print('Reusing already running service for ' + data)
+        else:
+            print('Launching new service for ' + data)
+            try:
+                service = self.create_service(data)
+                self.active[data] = service
+                await service.start()
+            except Exception as err:
+                print('Launching the service for ' + data + ' has failed: ' + str(err))
+                self.active.pop(data, None)
+            self.update_sessions()
+
+    def disconnect_service(self, identifier):
+        self.active.pop(identifier, None)
+        self.update_sessions()
+
+    def update_sessions(self):
+        ACTIVE_SESSIONS.set(len(self.active), (self.get_connection_channel(),))
+
+    async def dispatch(self):
+        # All messages are handled in order, so handlers should not block (see CBSRasyncService.run_in_executor)
+        while not self.stopping.is_set():
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None:
+                continue
+            channel = message['channel'].decode('utf-8')
+            handler = self.handlers.get(channel)
+            if handler is not None:
+                try:
+                    await handler(message)
+                except Exception as err:
+                    print('Handling a message on ' + channel + ' has failed: ' + str(err))
+
+    async def check_if_alive(self):
+        while not self.stopping.is_set():
+            try:
+                await wait_for(self.stopping.wait(), 60.1)
+                break
+            except AsyncTimeoutError:
+                pass
+            try:
+                await self.sweep()
+            except Exception as err:
+                print('Checking the connected devices has failed: ' + str(err))
+
+    async def sweep(self):
+        """
+        Shut down every service of which none of the devices has been seen in the last minute,
+        with a single pipeline for the devices of all services (as CBSRfactory.sweep).
+        """
+        start = time()
+        services = list(self.active.items())
+        service_devices = []
+        expired = []
+        for identifier, service in services:
+            try:
+                service_devices.append((identifier, service) + tuple(service.get_devices()))
+            except Exception as err:
+                print('Determining the devices of ' + identifier + ' has failed: ' + str(err))
+                expired.append((identifier, service))
+        devices = {}
+        for _, _, user, members in service_devices:
+            for member in members:
+                devices[(user, member)] = None
+        pipe = self.redis.pipeline(transaction=False)
+        for user, member in devices:
+            pipe.zscore(user, member)
+        for device, score in zip(list(devices.keys()), await pipe.execute()):
+            devices[device] = score
+
+        one_minute = mktime(gmtime()) - 60
+        for identifier, service, user, members in service_devices:
+            scores = [devices[(user, member)] for member in members]
+            if not any(score is not None and score >= one_minute for score in scores):
+                expired.append((identifier, service))
+        self.sweep_duration = time() - start
+        LIVENESS_SWEEP_SECONDS.set(self.sweep_duration, (self.get_connection_channel(),))
+        print('Checked %d services in %.1f ms (%d expired)' % (len(services), self.sweep_duration * 1000, len(expired)))
+        for identifier, service in expired:
+            try:
+                await service.shutdown()
+            except Exception as err:
+                print('Shutting down ' + identifier + ' has failed: ' + str(err))
+                self.disconnect_service(identifier)
+
+    async def main(self):
+        self.stopping = Event()
+        loop = get_event_loop()
+        loop.add_signal_handler(SIGTERM, self.stopping.set)
+        loop.add_signal_handler(SIGINT, self.stopping.set)
+        if self.metrics_port:
+            start_metrics_server(self.metrics_port)
+
+        # Redis initialization
+        self.redis = Redis(connection_pool=self.create_pool())
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        print('Subscribing...')
+        await self.subscribe({self.get_connection_channel(): self.start_service})
+        dispatch_task = loop.create_task(self.dispatch())
+        liveness_task = loop.create_task(self.check_if_alive())
+        await self.stopping.wait()
+
+        print('Trying to exit gracefully...')
+        try:
+            await wait_for(dispatch_task, 2)
+        except AsyncTimeoutError:
+            pass
+        liveness_task.cancel()
+        for service in list(self.active.values()):
+            await service.shutdown()
+        await self.pubsub.close()
+        await self.redis.close()
+        self.executor.shutdown(wait=False)
+        print('Graceful exit was successful')
+
+    def run(self):
+        run(self.main())
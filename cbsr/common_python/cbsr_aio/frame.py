@@ -0,0 +1,75 @@
+from os import getenv
+
+from cbsr.frame import decode_frame, DISTRIBUTION_CHANNEL, RedisFrameSource, RingFrameSource, TWELVE_HOURS
+from cbsr.frame_ring import FrameRingReader, get_ring_path
+from cbsr.trace import now_millis, TraceContext
+
+
+class AsyncRedisFrameSource(RedisFrameSource):
+    """
+    RedisFrameSource for a CBSRasyncService: the frame is fetched on the event loop, and decoded in the executor.
+    """
+
+    def get_channel_action_mapping(self, service, on_frame):
+        async def on_image_available(message):
+            self.seq += 1
+            self.timestamp = int(message['data'])
+            on_frame(self.timestamp)
+        return {service.get_full_channel('image_available'): on_image_available}
+
+    async def start(self, service):
+        await request_frame_format(service)
+
+    async def fetch(self, service):
+        # The image size is fetched along with every frame, as the device can change its format when it restarts
+        with service.measure('fetch'):
+            pipe = service.redis.pipeline()
+            pipe.get(service.get_full_channel('image_stream'))
+            pipe.get(service.get_full_channel('image_size'))
+            image_stream, image_size = await pipe.execute()
+        self.trace = TraceContext(self.seq, self.timestamp, now_millis())
+        self.decoder.set_image_size(image_size)
+
+        return await service.run_in_executor(decode_frame, self.decoder, service, image_stream)
+
+
+class AsyncRingFrameSource(RingFrameSource):
+    """
+    RingFrameSource for a CBSRasyncService: the frame is read from the ring (and converted) in the executor.
+    """
+
+    def get_channel_action_mapping(self, service, on_frame):
+        async def on_frame_available(message):
+            on_frame(int(message['data'].split(b';')[1]))  # 'seq;timestamp'
+        return {service.get_full_channel('frame_available'): on_frame_available}
+
+    async def start(self, service):
+        self.reader = FrameRingReader(get_ring_path(self.directory, service.identifier))
+        # Make sure the distribution service is running for this device (it is reused if it already is)
+        await service.redis.publish(DISTRIBUTION_CHANNEL, service.identifier)
+
+    async def fetch(self, service):
+        return await service.run_in_executor(super(AsyncRingFrameSource, self).fetch, service)
+
+
+async def request_frame_format(service):
+    """
+    Ask the device to send its frames in the FRAME_FORMAT (if set), see cbsr.frame.request_frame_format.
+    """
+    frame_format = getenv('FRAME_FORMAT')
+    if frame_format:
+        await service.redis.setex(service.get_full_channel('image_format'), TWELVE_HOURS, frame_format)
+
+
+def create_frame_source(output, shared=True):
+    """
+    As cbsr.frame.create_frame_source, for a CBSRasyncService: the shared memory frames of the frame
+    distribution service if FRAME_RING_DIR is set (and shared), or a GET after every image_available
+    notification otherwise (the frame stream of FRAME_TRANSPORT 'stream' is not supported, so the
+    device keeps announcing its frames for such a service).
+    """
+    directory = getenv('FRAME_RING_DIR')
+    if shared and directory:
+        return AsyncRingFrameSource(output, directory)
+    else:
+        return AsyncRedisFrameSource(output)
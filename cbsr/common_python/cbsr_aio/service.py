@@ -0,0 +1,145 @@
+from asyncio import Event, get_event_loop
+from os import getenv
+from time import time
+
+from cbsr.metrics import FRAMES_PROCESSED, FRAMES_RECEIVED, FRAMES_SKIPPED, FRAMES_STALE, STAGE_SECONDS
+from cbsr.trace import append_trace, TRACE_ENABLED
+
+
+class AsyncFrameSlot(object):
+    """
+    The FrameSlot (see cbsr.service) of a CBSRasyncService: the latest frame that was announced is put
+    by a handler, and taken (awaited) by the task that processes the frames of the session.
+    A closed slot cannot be opened again, so every session creates its own.
+    """
+
+    def __init__(self, service='', max_age=None):
+        self.labels = (service,)
+        self.max_age = int(getenv('FRAME_MAX_AGE_MS', '0')) if max_age is None else max_age
+        self.available = Event()
+        self.timestamp = None
+        self.closed = False
+        self.processed = 0
+        self.skipped = 0
+        self.stale = 0
+
+    def put(self, timestamp):
+        FRAMES_RECEIVED.inc(self.labels)
+        if self.timestamp is not None:
+            self.skipped += 1
+            FRAMES_SKIPPED.inc(self.labels)
+        self.timestamp = timestamp
+        self.available.set()
+
+    async def take(self):
+        """
+        Waits until a frame that is recent enough has been announced.
+        :return: the timestamp of that frame, or None if the slot was closed
+        """
+        while True:
+            await self.available.wait()
+            if self.closed:
+                return None
+            self.available.clear()
+            timestamp = self.timestamp
+            self.timestamp = None
+            if self.max_age and int(time() * 1000) - timestamp > self.max_age:
+                self.stale += 1
+                FRAMES_STALE.inc(self.labels)
+                continue
+            self.processed += 1
+            FRAMES_PROCESSED.inc(self.labels)
+            return timestamp
+
+    def close(self):
+        self.closed = True
+        self.available.set()
+
+    def __str__(self):
+        return 'processed %d, skipped %d and dropped %d stale frames' % (self.processed, self.skipped, self.stale)
+
+
+class CBSRasyncService(object):
+    """
+    The asyncio variant of CBSRservice, for a CBSRasyncFactory: its handlers are coroutine functions
+    that run on the event loop of the factory, so they must not block; CPU-heavy (or otherwise blocking)
+    work is run in the executor of the factory through run_in_executor.
+    """
+
+    def __init__(self, factory, identifier):
+        self.factory = factory
+        self.redis = factory.redis
+        self.identifier = identifier
+        self.running = True
+        self.channels = []
+
+    def get_device_types(self):
+        return []  # TO IMPLEMENT
+
+    def get_channel_action_mapping(self):
+        return {}  # TO IMPLEMENT: a coroutine function for every channel
+
+    async def cleanup(self):
+        pass  # TO IMPLEMENT
+
+    async def start(self):
+        print('Subscribing ' + self.identifier)
+        mapping = self.get_channel_action_mapping()
+        self.channels = list(mapping.keys())
+        await self.factory.subscribe(mapping)
+
+    def get_full_channel(self, channel_name):
+        return self.identifier + '_' + channel_name
+
+    def measure(self, stage):
+        """
+        Time a processing stage of this service, as in CBSRservice.measure
+        """
+        return STAGE_SECONDS.time((self.__class__.__name__, stage))
+
+    def get_user_id(self):
+        return self.identifier.split('-')[0]
+
+    def get_device_id(self):
+        return self.identifier.split('-')[1]
+
+    def get_devices(self):
+        """
+        :return: the key of the user and the members of that key for the devices this service depends on
+        """
+        device_id = self.get_device_id()
+        return 'user:' + self.get_user_id(), [device_id + ':' + device_type for device_type in self.get_device_types()]
+
+    async def run_in_executor(self, function, *args):
+        """
+        Run a blocking (e.g. CPU-heavy) function in the executor of the factory, without blocking the event loop.
+        """
+        return await get_event_loop().run_in_executor(self.factory.executor, function, *args)
+
+    async def publish(self, channel, data, trace=None):
+        """
+        :param trace: the TraceContext of the frame the data was derived from (if any), see CBSRservice.publish
+        """
+        if trace is not None and TRACE_ENABLED:
+            data = append_trace(data, trace)
+        with self.measure('publish'):
+            await self.redis.publish(self.get_full_channel(channel), data)
+
+    async def produce_event(self, event):
+        await self.publish('events', event)
+
+    async def shutdown(self):
+        if not self.running:
+            return
+        self.running = False
+        print('Trying to exit gracefully...')
+        try:
+            await self.cleanup()
+        except Exception as err:
+            print('Cleaning up ' + self.identifier + ' has failed: ' + str(err))
+        try:
+            await self.factory.unsubscribe(self.channels)
+            print('Graceful exit was successful')
+        except Exception as err:
+            print('Graceful exit has failed: ' + str(err))
+        self.factory.disconnect_service(self.identifier)
@@ -0,0 +1,52 @@
+from argparse import ArgumentParser
+from timeit import repeat
+
+from numpy import frombuffer, ones, random, reshape, uint8
+
+from cbsr.frame import FrameDecoder
+
+STREAM_SIZES = [(640, 480), (1280, 360)]
+
+
+def legacy_decode(image_stream, width, height):
+    # The YUV422 to YCbCr to RGB conversion the vision services used before cbsr.frame
+    from PIL import Image
+    image_array = frombuffer(image_stream, dtype=uint8)
+    y = image_array[0::2]
+    u = image_array[1::4]
+    v = image_array[3::4]
+    yuv = ones((len(y)) * 3, dtype=uint8)
+    yuv[::3] = y
+    yuv[1::6] = u
+    yuv[2::6] = v
+    yuv[4::6] = u
+    yuv[5::6] = v
+    yuv = reshape(yuv, (height, width, 3))
+    return Image.fromarray(yuv, 'YCbCr').convert('RGB')
+
+
+def time_per_frame(function, frames, repeats):
+    return min(repeat(function, number=frames, repeat=repeats)) / frames * 1000.0
+
+
+def run(frames, repeats, legacy):
+    for width, height in STREAM_SIZES:
+        image_stream = random.randint(0, 256, width * height * 2).astype(uint8).tobytes()
+        print('%dx%d YUV422 (%d bytes)' % (width, height, len(image_stream)))
+        if legacy:
+            cost = time_per_frame(lambda: legacy_decode(image_stream, width, height), frames, repeats)
+            print('  %-8s %.3f ms/frame' % ('legacy', cost))
+        for output in ['rgb', 'bgr', 'gray']:
+            decoder = FrameDecoder(output)
+            decoder.set_image_size('%d %d YUV' % (width, height))
+            cost = time_per_frame(lambda: decoder.decode(image_stream), frames, repeats)
+            print('  %-8s %.3f ms/frame' % (output, cost))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Microbenchmark of the YUV422 frame decoding in cbsr.frame')
+    parser.add_argument('--frames', type=int, default=100, help='Frames decoded per measurement')
+    parser.add_argument('--repeats', type=int, default=5, help='Measurements per output format (best is reported)')
+    parser.add_argument('--legacy', action='store_true', help='Also measure the old PIL-based conversion')
+    args = parser.parse_args()
+    run(args.frames, args.repeats, args.legacy)
@@ -0,0 +1,298 @@
+from argparse import ArgumentParser
+from importlib import import_module
+from json import dumps, loads
+from os import environ, getcwd, listdir
+from os.path import isdir, join
+from shutil import rmtree
+from sys import path
+from tempfile import mkdtemp
+from threading import Condition, Lock
+from time import sleep, time
+
+# The frames are replayed through the image_available protocol, with the results traced back to their frame
+environ.pop('FRAME_RING_DIR', None)
+environ.pop('FRAME_TRANSPORT', None)
+environ.pop('FRAME_FORMAT', None)
+environ['CBSR_TRACE'] = '1'
+# Anything a service stores (e.g. the face gallery) goes into a temporary directory instead of the production files
+environ['FACE_GALLERY_DIR'] = mkdtemp(prefix='replay')
+
+from cbsr.connection import CBSRconnection  # noqa: E402 (after the environment is set)
+from cbsr.trace import now_millis, split_trace  # noqa: E402
+
+IDENTIFIER = 'replay-device'
+
+
+class LocalBroker(object):
+    """
+    The in-process state of the LocalRedis clients: the keys and the subscriptions to every channel.
+    Every published message is also passed to the observers (i.e. the replay).
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.keys = {}
+        self.subscribers = {}
+        self.observers = []
+        self.gets = {}
+
+    def publish(self, channel, data):
+        if not isinstance(data, bytes):
+            data = str(data).encode('utf-8')
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, []))
+        for observer in self.observers:
+            observer(channel, data)
+        for subscriber in subscribers:
+            subscriber.deliver(channel, data)
+        return len(subscribers)
+
+
+class LocalPipeline(object):
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        results = [command(*args, **kwargs) for command, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class LocalPubSub(object):
+    def __init__(self, broker):
+        self.broker = broker
+        self.handlers = {}
+        self.messages = []
+        self.condition = Condition()
+
+    def subscribe(self, **handlers):
+        with self.broker.lock:
+            for channel, handler in handlers.items():
+                self.handlers[channel] = handler
+                self.broker.subscribers.setdefault(channel, []).append(self)
+
+    def unsubscribe(self, *channels):
+        with self.broker.lock:
+            for channel in channels:
+                self.handlers.pop(channel, None)
+                if self in self.broker.subscribers.get(channel, []):
+                    self.broker.subscribers[channel].remove(self)
+
+    def deliver(self, channel, data):
+        with self.condition:
+            self.messages.append({'type': 'message', 'pattern': None, 'channel': channel.encode('utf-8'),
+                                  'data': data})
+            self.condition.notify()
+
+    def get_message(self, timeout=0):
+        with self.condition:
+            if not self.messages:
+                self.condition.wait(timeout)
+            if not self.messages:
+                return None
+            message = self.messages.pop(0)
+        handler = self.handlers.get(message['channel'].decode('utf-8'))
+        if handler is None:
+            return message
+        handler(message)
+        return None
+
+    def close(self):
+        pass
+
+
+class LocalRedis(object):
+    """
+    A minimal in-process stand-in for the Redis commands that the (vision) services use.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def get(self, key):
+        with self.broker.lock:
+            self.broker.gets[key] = self.broker.gets.get(key, 0) + 1
+            return self.broker.keys.get(key)
+
+    def set(self, key, value):
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        with self.broker.lock:
+            self.broker.keys[key] = value
+        return True
+
+    def setex(self, key, seconds, value):
+        return self.set(key, value)
+
+    def delete(self, *keys):
+        with self.broker.lock:
+            return len([self.broker.keys.pop(key) for key in keys if key in self.broker.keys])
+
+    def zscore(self, key, member):
+        return time()  # every device is always connected
+
+    def publish(self, channel, data):
+        return self.broker.publish(channel, data)
+
+    def pipeline(self, transaction=True):
+        return LocalPipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return LocalPubSub(self.broker)
+
+    def close(self):
+        pass
+
+
+class LocalConnection(CBSRconnection):
+    """
+    Stands in for the connection of a factory, so the service subscribes through a single LocalPubSub
+    and leaves the liveness checks to the (absent) factory.
+    """
+
+    def __init__(self, broker):
+        super(LocalConnection, self).__init__(None)
+        self.broker = broker
+
+    def __call__(self):
+        return LocalRedis(self.broker)
+
+    def close(self):
+        self.stop()  # there is no pool to disconnect
+
+
+def read_frames(frames_path, frame_size):
+    """
+    :param frames_path: a file with consecutive raw frames (as in image_stream), or a directory with one file per frame
+    """
+    if isdir(frames_path):
+        frames = []
+        for name in sorted(listdir(frames_path)):
+            with open(join(frames_path, name), 'rb') as frame_file:
+                frames.append(frame_file.read())
+        return frames
+    if not frame_size:
+        raise ValueError('Compressed frames (e.g. JPEG) can only be replayed from a directory with one file per frame')
+    with open(frames_path, 'rb') as frames_file:
+        data = frames_file.read()
+    return [data[start:start + frame_size] for start in range(0, len(data) - frame_size + 1, frame_size)]
+
+
+def get_frame_size(image_size):
+    width, height, color_space = image_size.split()
+    return int(width) * int(height) * {'YUV': 2, 'RGB': 3, 'Y': 1}.get(color_space, 0)
+
+
+def create_service(factory_name, connect, disconnect):
+    # The factory is only used to create (and prepare) its service, without connecting it to Redis
+    module_name, class_name = factory_name.split(':')
+    factory_class = getattr(import_module(module_name), class_name)
+    factory = factory_class.__new__(factory_class)
+    factory.prepare()
+    return factory, factory.create_service(connect, IDENTIFIER, disconnect)
+
+
+def replay(factory_name, frames_path, image_size, rate, linger, timeout):
+    broker = LocalBroker()
+    results = []
+    result_times = []
+
+    def observe(channel, data):
+        if channel.startswith(IDENTIFIER + '_') and channel != IDENTIFIER + '_image_available':
+            result_times.append(time())
+            try:
+                data = data.decode('utf-8')
+            except UnicodeDecodeError:
+                return  # e.g. pictures
+            payload, trace = split_trace(data)
+            if trace is not None:
+                results.append({'channel': channel.split('_', 1)[1], 'data': payload, 'frame': trace[0],
+                                'latency': now_millis() - trace[1]})
+    broker.observers.append(observe)
+
+    client = LocalRedis(broker)
+    client.set(IDENTIFIER + '_image_size', image_size)
+    frames = read_frames(frames_path, get_frame_size(image_size))
+    print('Replaying %d frames into %s' % (len(frames), factory_name))
+    connection = LocalConnection(broker)
+    factory, service = create_service(factory_name, connection, lambda identifier: None)
+
+    client.publish(IDENTIFIER + '_events', 'WatchingStarted')
+    start = time()
+    try:
+        for index, frame in enumerate(frames):
+            client.set(IDENTIFIER + '_image_stream', frame)
+            client.publish(IDENTIFIER + '_image_available', str(now_millis()))
+            if rate > 0:
+                sleep(max(0.0, start + (index + 1) / rate - time()))
+            else:  # lockstep: wait until the service has fetched this frame, so no frame is ever skipped
+                deadline = time() + timeout
+                while broker.gets.get(IDENTIFIER + '_image_stream', 0) <= index:
+                    if time() > deadline:
+                        raise RuntimeError('The service did not fetch frame %d within %.1f s' % (index, timeout))
+                    sleep(0.0005)
+        # Wait for the results of the last frames
+        last_frame = time()
+        while time() - max([last_frame] + result_times) < linger:
+            sleep(0.1)
+        elapsed = max([last_frame] + result_times) - start
+    finally:
+        client.publish(IDENTIFIER + '_events', 'WatchingDone')
+        service.shutdown()
+        factory.release()
+        connection.close()
+
+    fetched = broker.gets.get(IDENTIFIER + '_image_stream', 0)
+    print('Fetched %d of %d frames in %.2f s: %.1f frames/s, %d results'
+          % (fetched, len(frames), elapsed, fetched / elapsed, len(results)))
+    if results:
+        latencies = sorted(result['latency'] for result in results)
+        print('Latency from frame to result: p50 %d ms, p90 %d ms, max %d ms'
+              % (latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.9)], latencies[-1]))
+    return results
+
+
+def compare(results, expected_path):
+    with open(expected_path) as expected_file:
+        expected = [loads(line) for line in expected_file]
+    key = lambda result: (result['frame'], result['channel'], result['data'])  # noqa: E731
+    actual_keys = set(key(result) for result in results)
+    expected_keys = set(key(result) for result in expected)
+    print('Result parity: %d matching, %d missing, %d unexpected'
+          % (len(actual_keys & expected_keys), len(expected_keys - actual_keys), len(actual_keys - expected_keys)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Replay recorded frames into a service (run from the directory of the service)')
+    parser.add_argument('--factory', type=str, required=True,
+                        help='module:class of the factory of the service, e.g. people_detection_factory:PeopleDetectionFactory')
+    parser.add_argument('--frames', type=str, required=True, help='File with raw frames, or a directory of frames')
+    parser.add_argument('--size', type=str, default='640 480 YUV', help='The image_size of the frames')
+    parser.add_argument('--rate', type=float, default=0, help='Frames per second (0 = as fast as the service fetches)')
+    parser.add_argument('--linger', type=float, default=2, help='Seconds to wait for results after the last frame')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='Seconds to wait for the service to fetch a frame (with --rate 0) before giving up')
+    parser.add_argument('--output', type=str, help='Write the results (as JSON lines) to this file')
+    parser.add_argument('--expected', type=str, help='Compare the results with those of an earlier --output')
+    args = parser.parse_args()
+
+    path.insert(0, getcwd())
+    try:
+        replay_results = replay(args.factory, args.frames, args.size, args.rate, args.linger, args.timeout)
+    finally:
+        rmtree(environ['FACE_GALLERY_DIR'], ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            for replay_result in replay_results:
+                output_file.write(dumps(replay_result) + '\n')
+    if args.expected:
+        compare(replay_results, args.expected)
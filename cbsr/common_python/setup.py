@@ -1,3 +1,5 @@
+from sys import version_info
+
 from setuptools import setup
 
 setup(
@@ -5,5 +7,6 @@ setup(
   version='0.0.1',
   author='Vincent Koeman',
   author_email='v.j.koeman@vu.nl',
-  packages=['cbsr'],
+  # The asyncio runtime (cbsr_aio) is only installed for Python 3
+  packages=['cbsr'] + (['cbsr_aio'] if version_info[0] >= 3 else []),
 )
\ No newline at end of file
@@ -0,0 +1,83 @@
+from argparse import ArgumentParser
+from json import dumps, loads
+
+from redis import Redis
+
+from cbsr.trace import now_millis, split_trace
+
+# The hops of a frame: (name, start field, end field) over capture (produced), fetch (received), publish and delivery
+HOPS = [('capture-fetch', 1, 2), ('fetch-publish', 2, 3), ('publish-deliver', 3, 4), ('capture-deliver', 1, 4)]
+PERCENTILES = [50, 90, 99]
+
+
+def record(redis, identifier, path):
+    """
+    Write every (text) message that is published for the identifier to a file, one JSON object per line,
+    together with the time at which it was received; stop with Ctrl+C.
+    """
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.psubscribe(identifier + '_*')
+    count = 0
+    with open(path, 'w') as recording:
+        try:
+            for message in pubsub.listen():
+                received = now_millis()
+                try:
+                    data = message['data'].decode('utf-8')
+                except UnicodeDecodeError:
+                    continue  # e.g. pictures
+                recording.write(dumps({'time': received, 'channel': message['channel'].decode('utf-8'),
+                                       'data': data}) + '\n')
+                count += 1
+        except KeyboardInterrupt:
+            pass
+    print('Recorded %d messages in %s' % (count, path))
+
+
+def percentile(values, percent):
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def report(path):
+    """
+    Print the latency percentiles per hop for every result channel in a recording (which requires the
+    services to run with CBSR_TRACE=1), and of the image announcements themselves.
+    """
+    latencies = {}
+    with open(path) as recording:
+        for line in recording:
+            message = loads(line)
+            channel = message['channel'].split('_', 1)[-1]
+            if channel == 'image_available':
+                latencies.setdefault((channel, 'capture-deliver'), []).append(message['time'] - int(message['data']))
+                continue
+            _, trace = split_trace(message['data'])
+            if trace is None:
+                continue
+            times = trace + (message['time'],)
+            for hop, start, end in HOPS:
+                latencies.setdefault((channel, hop), []).append(times[end] - times[start])
+
+    print('%-20s %-16s %8s ' % ('channel', 'hop', 'count') + ' '.join('%7s' % ('p' + str(p)) for p in PERCENTILES))
+    for (channel, hop), values in sorted(latencies.items()):
+        values.sort()
+        print('%-20s %-16s %8d ' % (channel, hop, len(values)) +
+              ' '.join('%5d ms' % percentile(values, p) for p in PERCENTILES))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Record the messages of a session, or report the latencies in a recording')
+    parser.add_argument('command', choices=['record', 'report'])
+    parser.add_argument('--file', type=str, default='trace.jsonl', help='The recording')
+    parser.add_argument('--identifier', type=str, help='The user-device identifier of the session to record')
+    parser.add_argument('--server', type=str, help='Server IP address')
+    parser.add_argument('--password', type=str, help='Password')
+    parser.add_argument('--cert', type=str, help='CA certificate (for a self-signed server)')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(Redis(host=args.server, password=args.password, ssl=True, ssl_ca_certs=args.cert),
+               args.identifier, args.file)
+    else:
+        report(args.file)
@@ -1,17 +1,17 @@
-from cbsr.factory import CBSRfactory
+from cbsr_aio.factory import CBSRasyncFactory
 
 from corona_check_service import CoronaCheckService
 
 
-class CoronaCheckFactory(CBSRfactory):
+class CoronaCheckFactory(CBSRasyncFactory):
     def __init__(self):
         super(CoronaCheckFactory, self).__init__()
 
     def get_connection_channel(self):
         return 'corona_check'
 
-    def create_service(self, connect, identifier, disconnect):
-        return CoronaCheckService(connect, identifier, disconnect)
+    def create_service(self, identifier):
+        return CoronaCheckService(self, identifier)
 
 
 if __name__ == '__main__':
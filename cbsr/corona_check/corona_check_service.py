@@ -1,108 +1,82 @@
+from asyncio import get_event_loop
 from os import environ
-from threading import Event, Thread
 
-import numpy as np
-from PIL import Image
-from cbsr.service import CBSRservice
+from cbsr_aio.frame import create_frame_source
+from cbsr_aio.service import AsyncFrameSlot, CBSRasyncService
 from coronacheck_tools.clitools import convert
 from coronacheck_tools.verification.verifier import validate_raw
-from cv2 import cvtColor, COLOR_BGRA2RGB
 
 
-class CoronaCheckService(CBSRservice):
-    def __init__(self, connect, identifier, disconnect):
-        super(CoronaCheckService, self).__init__(connect, identifier, disconnect)
-
-        # Image size (filled later)
-        self.image_width = 0
-        self.image_height = 0
-        self.color_space = None
-        # Thread data
-        self.is_checking = False
-        self.is_image_available = False
-        self.image_available_flag = Event()
+class CoronaCheckService(CBSRasyncService):
+    def __init__(self, factory, identifier):
+        super(CoronaCheckService, self).__init__(factory, identifier)
+        # Frames are fetched from Redis, or from the frame distribution service if available
+        self.frame_source = create_frame_source('rgb')
+        # Only the latest frame that was announced is processed (a new slot for every session)
+        self.frame_slot = None
 
         # QR code option
         self.allow_international = False
         environ['XDG_CONFIG_HOME'] = '/coronacheck/.config'
 
+    async def start(self):
+        await super(CoronaCheckService, self).start()
+        await self.frame_source.start(self)
+
     def get_device_types(self):
         return ['cam']
 
     def get_channel_action_mapping(self):
-        return {self.get_full_channel('events'): self.execute,
-                self.get_full_channel('image_available'): self.set_image_available}
+        mapping = {self.get_full_channel('events'): self.execute}
+        mapping.update(self.frame_source.get_channel_action_mapping(self, self.put_frame))
+        return mapping
+
+    def put_frame(self, timestamp):
+        if self.frame_slot is not None:
+            self.frame_slot.put(timestamp)
 
-    def execute(self, message):
+    async def execute(self, message):
         data = message['data'].decode()
         if data == 'WatchingStarted':
-            if not self.is_checking:
-                self.is_checking = True
-                corona_check_thread = Thread(target=self.corona_check)
-                corona_check_thread.start()
+            if self.frame_slot is None:
+                self.frame_slot = AsyncFrameSlot(self.__class__.__name__)
+                get_event_loop().create_task(self.corona_check(self.frame_slot))
             else:
                 print('Corona checker already running for ' + self.identifier)
         elif data == 'WatchingDone':
-            if self.is_checking:
-                self.is_checking = False
-                self.image_available_flag.set()
+            if self.frame_slot is not None:
+                self.frame_slot.close()
+                self.frame_slot = None
             else:
                 print('Corona checker already stopped for ' + self.identifier)
 
-    def corona_check(self):
-        self.produce_event('CoronaCheckStarted')
-        while self.is_checking:
-            if self.is_image_available:
-                self.is_image_available = False
-                self.image_available_flag.clear()
+    async def corona_check(self, frame_slot):
+        await self.produce_event('CoronaCheckStarted')
+        while True:
+            if await frame_slot.take() is None:
+                break  # stopped
 
-                # Get the raw bytes from Redis
-                image_stream = self.redis.get(self.get_full_channel('image_stream'))
-                if self.image_width == 0 or self.image_height == 0:
-                    image_size = self.redis.get(self.get_full_channel('image_size')).decode().split()
-                    self.image_width = int(image_size[0])
-                    self.image_height = int(image_size[1])
-                    self.color_space = image_size[2]
+            input_data = await self.frame_source.fetch(self)
+            if input_data is None:
+                continue
 
-                if self.color_space == 'RGB':
-                    image = Image.frombytes('RGB', (self.image_width, self.image_height), image_stream)
-                elif self.color_space == 'YUV':
-                    # YUV type juggling (end up with YUV444 which is YCbCr which PIL can read directly)
-                    image_array = np.frombuffer(image_stream, dtype=np.uint8)
-                    y = image_array[0::2]
-                    u = image_array[1::4]
-                    v = image_array[3::4]
-                    yuv = np.ones((len(y)) * 3, dtype=np.uint8)
-                    yuv[::3] = y
-                    yuv[1::6] = u
-                    yuv[2::6] = v
-                    yuv[4::6] = u
-                    yuv[5::6] = v
-                    yuv = np.reshape(yuv, (self.image_height, self.image_width, 3))
-                    image = Image.fromarray(yuv, 'YCbCr').convert('RGB')
-                else:
-                    print('Unknown color space: ' + self.color_space)
-                    continue
-
-                input_data = cvtColor(np.array(image), COLOR_BGRA2RGB)
-                # imwrite('/coronacheck/' + str(time_ns()) + '.jpg', input_data)
-
-                data = convert('QR', input_data, 'RAW')
-                if isinstance(data, list):
-                    data = data[0] if len(data) > 0 else None  # if we have multiple QR codes only verify the first one
-                if data:
-                    result = validate_raw(data, allow_international=self.allow_international)
-                    if result[0]:
-                        self.publish('corona_check', '1')
-            else:
-                self.image_available_flag.wait()
-        self.produce_event('CoronaCheckDone')
+            # The QR code detection is CPU-bound, so it runs in the executor of the factory
+            if await self.run_in_executor(self.check_qr_code, input_data):
+                await self.publish('corona_check', '1', self.frame_source.trace)
+        print(self.identifier + ': ' + str(frame_slot))
+        await self.produce_event('CoronaCheckDone')
 
-    def set_image_available(self, message):
-        if not self.is_image_available:
-            self.is_image_available = True
-            self.image_available_flag.set()
+    def check_qr_code(self, input_data):
+        with self.measure('detect'):
+            data = convert('QR', input_data, 'RAW')
+        if isinstance(data, list):
+            data = data[0] if len(data) > 0 else None  # if we have multiple QR codes only verify the first one
+        if data:
+            result = validate_raw(data, allow_international=self.allow_international)
+            return result[0]
+        return False
 
-    def cleanup(self):
-        self.image_available_flag.set()
-        self.is_checking = False
+    async def cleanup(self):
+        if self.frame_slot is not None:
+            self.frame_slot.close()
+            self.frame_slot = None
@@ -0,0 +1,125 @@
+from fcntl import flock, LOCK_EX, LOCK_UN
+from os.path import getsize, isfile
+from pickle import load
+
+from numpy import asarray, einsum, empty, float32, fromfile, sqrt
+
+from face_index import ExactFaceIndex, squared_distances
+
+
+class FaceGallery(object):
+    """
+    All known face encodings, kept in one contiguous float32 array (that grows geometrically) so that
+    the distances from all faces in a frame to all known faces are computed in a single matrix product.
+    The encodings are persisted in an append-only file of raw float32 records, so enrolling a face
+    only writes that face instead of rewriting the whole gallery.
+    Lookups use an exact linear scan, unless another index is given and the gallery has at least
+    min_index_size faces (an approximate index does not pay off for small galleries).
+    Several processes can share the file (see CBSRfactory's CBSR_WORKERS): faces that the others
+    have enrolled are loaded before every lookup, and enrolling a face locks the file.
+    """
+
+    def __init__(self, path='face_encodings.bin', legacy_path='face_encodings.p', dimensions=128, capacity=64,
+                 index=None, min_index_size=5000):
+        self.path = path
+        self.exact_index = ExactFaceIndex()
+        self.index = index or self.exact_index
+        self.min_index_size = min_index_size
+        self.dimensions = dimensions
+        self.record_size = dimensions * 4
+        self.count = 0
+        self.encodings = empty((capacity, dimensions), dtype=float32)
+        self.squared_norms = empty(capacity, dtype=float32)
+
+        if isfile(self.path):
+            # Ignore a partially written record at the end (e.g. after a crash during an append)
+            records = getsize(self.path) // self.record_size
+            stored = fromfile(self.path, dtype=float32, count=records * dimensions).reshape((records, dimensions))
+            self.extend(stored)
+        elif isfile(legacy_path):
+            # Convert the pickled list of encodings used by earlier versions
+            with open(legacy_path, 'rb') as legacy_file:
+                stored = load(legacy_file)
+            if stored:
+                self.extend(asarray(stored, dtype=float32))
+            self.encodings[:self.count].tofile(self.path)
+        self.log = open(self.path, 'ab')
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, capacity):
+        if capacity <= self.encodings.shape[0]:
+            return
+        new_capacity = self.encodings.shape[0]
+        while new_capacity < capacity:
+            new_capacity *= 2
+        encodings = empty((new_capacity, self.dimensions), dtype=float32)
+        encodings[:self.count] = self.encodings[:self.count]
+        squared_norms = empty(new_capacity, dtype=float32)
+        squared_norms[:self.count] = self.squared_norms[:self.count]
+        self.encodings = encodings
+        self.squared_norms = squared_norms
+
+    def extend(self, face_encodings):
+        self.reserve(self.count + len(face_encodings))
+        new_count = self.count + len(face_encodings)
+        self.encodings[self.count:new_count] = face_encodings
+        self.squared_norms[self.count:new_count] = einsum('ij,ij->i', self.encodings[self.count:new_count],
+                                                          self.encodings[self.count:new_count])
+        self.count = new_count
+
+    def refresh(self):
+        """
+        Load the faces that other processes have appended to the file since it was last read.
+        """
+        records = getsize(self.path) // self.record_size
+        if records <= self.count:
+            return
+        first = self.count
+        with open(self.path, 'rb') as stored_file:
+            stored_file.seek(first * self.record_size)
+            stored = fromfile(stored_file, dtype=float32, count=(records - first) * self.dimensions)
+        self.extend(stored.reshape((-1, self.dimensions)))
+        for index in range(first, self.count):
+            self.index.add(self, index)
+
+    def add(self, face_encoding):
+        """
+        :return: the index of the newly enrolled face
+        """
+        flock(self.log, LOCK_EX)
+        try:
+            self.refresh()
+            index = self.count
+            self.extend(asarray(face_encoding, dtype=float32).reshape((1, self.dimensions)))
+            self.log.write(self.encodings[index].tobytes())
+            self.log.flush()
+        finally:
+            flock(self.log, LOCK_UN)
+        self.index.add(self, index)
+        return index
+
+    def distances(self, face_encodings):
+        """
+        :param face_encodings: the encodings of all faces in a frame
+        :return: array with the euclidean distance of every given face (rows) to every known face (columns)
+        """
+        queries = asarray(face_encodings, dtype=float32).reshape((-1, self.dimensions))
+        return sqrt(squared_distances(queries, self.encodings[:self.count], self.squared_norms[:self.count]))
+
+    def search(self, face_encodings, tolerance):
+        """
+        :param face_encodings: the encodings of all faces in a frame
+        :return: for every face the index of the first known face within the tolerance (or -1),
+                 the index of the nearest known face and the distance to it
+        """
+        self.refresh()
+        if self.count == 0:
+            return [(-1, -1, float('inf'))] * len(face_encodings)
+        queries = asarray(face_encodings, dtype=float32).reshape((-1, self.dimensions))
+        index = self.index if self.count >= self.min_index_size else self.exact_index
+        return index.search(self, queries, tolerance)
+
+    def close(self):
+        self.log.close()
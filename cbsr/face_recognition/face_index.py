@@ -0,0 +1,139 @@
+from os import getenv
+
+from numpy import argmin, argsort, bincount, concatenate, cumsum, einsum, empty, flatnonzero, float32, int32, \
+    int64, maximum, random, sqrt, zeros
+
+
+def squared_distances(queries, vectors, vector_norms):
+    # |a - b|^2 = |a|^2 + |b|^2 - 2ab, clipped at 0 to guard against rounding errors
+    squared = einsum('ij,ij->i', queries, queries)[:, None] + vector_norms - 2 * queries.dot(vectors.T)
+    return maximum(squared, 0)
+
+
+class ExactFaceIndex(object):
+    """
+    Linear scan over all known faces (a single matrix product per frame).
+    """
+
+    def add(self, gallery, index):
+        pass
+
+    def search(self, gallery, queries, tolerance):
+        """
+        :return: for every query the index of the first known face within the tolerance (or -1),
+                 the index of the nearest known face and the distance to it
+        """
+        results = []
+        for dist in gallery.distances(queries):
+            matches = flatnonzero(dist <= tolerance)
+            nearest = int(argmin(dist))
+            results.append((int(matches[0]) if len(matches) else -1, nearest, float(dist[nearest])))
+        return results
+
+
+class IVFFaceIndex(object):
+    """
+    Inverted file index: the known faces are clustered with k-means, and a query is only compared with
+    the faces in the n_probe clusters nearest to it. Faces enrolled after the last (re)build are kept in
+    a tail that is always scanned, until the lists are rebuilt; the clustering itself is retrained
+    whenever the gallery has doubled in size since the last training.
+    """
+
+    def __init__(self, n_probe=8, rebuild_size=1024, kmeans_iterations=10, max_training_size=20000):
+        self.n_probe = n_probe
+        self.rebuild_size = rebuild_size
+        self.kmeans_iterations = kmeans_iterations
+        self.max_training_size = max_training_size
+        self.centroids = None
+        self.trained_count = 0
+        self.assignments = empty(0, dtype=int32)
+        self.order = empty(0, dtype=int64)
+        self.offsets = zeros(1, dtype=int64)
+        self.indexed_count = 0
+
+    def train(self, gallery):
+        vectors = gallery.encodings[:gallery.count]
+        sample = vectors
+        if len(sample) > self.max_training_size:
+            sample = vectors[random.choice(len(vectors), self.max_training_size, replace=False)]
+        n_lists = max(1, int(sqrt(len(vectors))))
+        centroids = sample[random.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(self.kmeans_iterations):
+            labels = self.assign(centroids, sample)
+            counts = bincount(labels, minlength=n_lists)
+            sums = zeros(centroids.shape, dtype=float32)
+            for dimension in range(centroids.shape[1]):
+                sums[:, dimension] = bincount(labels, weights=sample[:, dimension], minlength=n_lists)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+        self.centroids = centroids
+        self.trained_count = len(vectors)
+        self.assignments = self.assign(centroids, vectors)
+        self.rebuild(gallery)
+
+    @staticmethod
+    def assign(centroids, vectors, chunk_size=8192):
+        labels = empty(len(vectors), dtype=int32)
+        centroid_norms = einsum('ij,ij->i', centroids, centroids)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = vectors[start:start + chunk_size]
+            labels[start:start + chunk_size] = argmin(squared_distances(chunk, centroids, centroid_norms), axis=1)
+        return labels
+
+    def rebuild(self, gallery):
+        count = gallery.count
+        self.order = argsort(self.assignments[:count], kind='mergesort')
+        self.offsets = concatenate([[0], cumsum(bincount(self.assignments[:count], minlength=len(self.centroids)))])
+        self.indexed_count = count
+
+    def add(self, gallery, index):
+        if self.centroids is None:
+            return
+        if gallery.count >= 2 * self.trained_count:
+            self.train(gallery)
+            return
+        if len(self.assignments) < gallery.count:
+            assignments = empty(max(gallery.count, 2 * len(self.assignments)), dtype=int32)
+            assignments[:len(self.assignments)] = self.assignments
+            self.assignments = assignments
+        self.assignments[index] = self.assign(self.centroids, gallery.encodings[index:index + 1])[0]
+        if gallery.count - self.indexed_count >= self.rebuild_size:
+            self.rebuild(gallery)
+
+    def search(self, gallery, queries, tolerance):
+        if self.centroids is None:
+            self.train(gallery)
+        centroid_norms = einsum('ij,ij->i', self.centroids, self.centroids)
+        probes = argsort(squared_distances(queries, self.centroids, centroid_norms), axis=1)[:, :self.n_probe]
+        tail = range(self.indexed_count, gallery.count)
+        results = []
+        for query, query_probes in zip(queries, probes):
+            candidates = concatenate([self.order[self.offsets[probe]:self.offsets[probe + 1]]
+                                      for probe in query_probes] + [tail]).astype(int64)
+            if len(candidates) == 0:
+                results.append((-1, -1, float('inf')))
+                continue
+            candidates.sort()  # so that the first match is the known face that was enrolled first
+            dist = sqrt(squared_distances(query[None, :], gallery.encodings[candidates],
+                                          gallery.squared_norms[candidates])[0])
+            matches = flatnonzero(dist <= tolerance)
+            nearest = int(argmin(dist))
+            results.append((int(candidates[matches[0]]) if len(matches) else -1,
+                            int(candidates[nearest]), float(dist[nearest])))
+        return results
+
+
+FACE_INDEXES = {'exact': ExactFaceIndex, 'ivf': IVFFaceIndex}
+
+
+def create_face_index(name=None):
+    """
+    :param name: the index to use ('exact' or 'ivf'); defaults to the FACE_INDEX environment variable
+    """
+    name = name or getenv('FACE_INDEX', 'exact')
+    if name == 'ivf':
+        return IVFFaceIndex(n_probe=int(getenv('FACE_INDEX_NPROBE', '8')))
+    elif name in FACE_INDEXES:
+        return FACE_INDEXES[name]()
+    else:
+        raise ValueError('Unknown face index: ' + name)
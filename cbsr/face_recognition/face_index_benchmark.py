@@ -0,0 +1,80 @@
+from argparse import ArgumentParser
+from os import remove
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from timeit import default_timer
+
+from numpy import float32, mean, random
+from numpy.linalg import norm
+
+from face_gallery import FaceGallery
+from face_index import create_face_index
+
+TOLERANCE = 0.6
+
+
+def synthetic_encodings(count, dimensions, identities):
+    # Face encodings cluster per person: a random identity centre plus some per-picture noise
+    centres = random.normal(0, 0.1, (identities, dimensions)).astype(float32)
+    owners = random.randint(0, identities, count)
+    noise = random.normal(0, 0.02, (count, dimensions)).astype(float32)
+    return centres[owners] + noise, centres
+
+
+def build_gallery(directory, encodings, index_name):
+    path = join(directory, index_name + '.bin')
+    gallery = FaceGallery(path=path, legacy_path=join(directory, 'none.p'), index=create_face_index(index_name),
+                          min_index_size=0)
+    gallery.extend(encodings)
+    return gallery, path
+
+
+def measure(gallery, queries, repeats):
+    gallery.search(queries[:1], TOLERANCE)  # warm-up (and training of an approximate index)
+    start = default_timer()
+    results = None
+    for _ in range(repeats):
+        results = [gallery.search(query[None, :], TOLERANCE)[0] for query in queries]
+    return (default_timer() - start) / (repeats * len(queries)) * 1000.0, results
+
+
+def run(sizes, dimensions, queries, repeats, indexes):
+    directory = mkdtemp()
+    try:
+        for size in sizes:
+            encodings, centres = synthetic_encodings(size, dimensions, max(1, size // 4))
+            probe_owners = random.randint(0, len(centres), queries)
+            probes = centres[probe_owners] + random.normal(0, 0.02, (queries, dimensions)).astype(float32)
+            print('%d faces, %d queries' % (size, queries))
+
+            exact, exact_path = build_gallery(directory, encodings, 'exact')
+            exact_cost, exact_results = measure(exact, probes, repeats)
+            print('  %-6s %8.3f ms/face' % ('exact', exact_cost))
+            exact.close()
+            remove(exact_path)
+
+            for index_name in indexes:
+                gallery, path = build_gallery(directory, encodings, index_name)
+                cost, results = measure(gallery, probes, repeats)
+                # Recall@1: the approximate nearest face is (as near as) the exact nearest face
+                hits = [norm(encodings[result[1]] - probe) <= expected[2] + 1e-5
+                        for result, expected, probe in zip(results, exact_results, probes)]
+                decisions = [(result[0] < 0) == (expected[0] < 0) for result, expected in zip(results, exact_results)]
+                print('  %-6s %8.3f ms/face  recall@1 %.3f  same new/known decision %.3f  speed-up %.1fx'
+                      % (index_name, cost, mean(hits), mean(decisions), exact_cost / cost))
+                gallery.close()
+                remove(path)
+    finally:
+        rmtree(directory)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Latency and recall of the face indexes against the exact search')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Gallery sizes')
+    parser.add_argument('--dimensions', type=int, default=128, help='Size of a face encoding')
+    parser.add_argument('--queries', type=int, default=200, help='Faces looked up per gallery size')
+    parser.add_argument('--repeats', type=int, default=3, help='Repetitions of all lookups')
+    parser.add_argument('--index', type=str, nargs='+', default=['ivf'], help='Approximate indexes to compare')
+    args = parser.parse_args()
+    run(args.sizes, args.dimensions, args.queries, args.repeats, args.index)
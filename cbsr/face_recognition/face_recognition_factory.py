@@ -1,17 +1,40 @@
+from os import getenv
+from os.path import join
+
 from cbsr.factory import CBSRfactory
 
+from face_gallery import FaceGallery
+from face_index import create_face_index
 from face_recognition_service import FaceRecognitionService
+from face_recognition_worker import FaceRecognitionWorker
 
 
 class FaceRecognitionFactory(CBSRfactory):
     def __init__(self):
+        self.gallery = None
+        self.worker = None
         super(FaceRecognitionFactory, self).__init__()
 
     def get_connection_channel(self):
         return 'face_recognition'
 
     def create_service(self, connect, identifier, disconnect):
-        return FaceRecognitionService(connect, identifier, disconnect)
+        return FaceRecognitionService(connect, identifier, disconnect, self.worker, self.gallery)
+
+    def prepare(self):
+        # The exact search is used until the gallery reaches FACE_INDEX_MIN_SIZE faces
+        gallery_dir = getenv('FACE_GALLERY_DIR', '.')
+        self.gallery = FaceGallery(path=join(gallery_dir, 'face_encodings.bin'),
+                                   legacy_path=join(gallery_dir, 'face_encodings.p'), index=create_face_index(),
+                                   min_index_size=int(getenv('FACE_INDEX_MIN_SIZE', '5000')))
+        # A single worker (per process) batches the face detection and encoding of all sessions
+        self.worker = FaceRecognitionWorker(max_batch_size=int(getenv('FACE_BATCH_SIZE', '8')),
+                                            max_wait=float(getenv('FACE_BATCH_WAIT_MS', '20')) / 1000.0,
+                                            model=getenv('FACE_DETECTION_MODEL', 'hog'))
+
+    def release(self):
+        self.worker.stop()
+        self.gallery.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from threading import Condition, Thread
+from time import time
+
+import face_recognition
+from cbsr.metrics import QUEUE_DEPTH, STAGE_SECONDS
+from dlib import full_object_detections, rectangle
+from face_recognition.api import face_encoder, pose_predictor_5_point
+from numpy import array
+
+
+class FaceRecognitionWorker(object):
+    """
+    Runs face detection and encoding for all FaceRecognitionServices of a factory on a single thread.
+    Every session has at most one pending frame (a newer frame replaces an older one that was not
+    picked up yet), and pending frames of all sessions are processed together in batches of at most
+    max_batch_size frames, waiting at most max_wait seconds for a batch to fill up.
+    """
+
+    def __init__(self, max_batch_size, max_wait, model='hog'):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.model = model
+        self.pending = OrderedDict()
+        self.condition = Condition()
+        self.running = True
+
+        worker_thread = Thread(target=self.run)
+        worker_thread.start()
+
+    def submit(self, service, image, trace=None):
+        with self.condition:
+            # Copy the image, as the frame source reuses its buffer for the next frame
+            self.pending[service.identifier] = (service, image.copy(), trace)
+            QUEUE_DEPTH.set(len(self.pending), ('face_recognition',))
+            self.condition.notify()
+
+    def cancel(self, identifier):
+        with self.condition:
+            self.pending.pop(identifier, None)
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                deadline = time() + self.max_wait
+                while self.running and len(self.pending) < self.max_batch_size:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = []
+                while self.pending and len(batch) < self.max_batch_size:
+                    batch.append(self.pending.popitem(last=False)[1])
+                QUEUE_DEPTH.set(len(self.pending), ('face_recognition',))
+            if batch:
+                self.process_batch(batch)
+
+    def process_batch(self, batch):
+        images = [image for _, image, _ in batch]
+        try:
+            with STAGE_SECONDS.time(('FaceRecognitionWorker', 'detect')):
+                batch_face_locations = self.locate_faces(images)
+            with STAGE_SECONDS.time(('FaceRecognitionWorker', 'encode')):
+                batch_face_encodings = self.encode_faces(images, batch_face_locations)
+        except Exception as err:
+            print('Face recognition of a batch of ' + str(len(batch)) + ' frames has failed: ' + str(err))
+            return
+        for (service, _, trace), face_encodings in zip(batch, batch_face_encodings):
+            if not service.running:
+                continue  # shut down while its frame was being processed
+            try:
+                service.process_face_encodings(face_encodings, trace)
+            except Exception as err:
+                print(service.identifier + ': processing the recognised faces has failed: ' + str(err))
+
+    def locate_faces(self, images):
+        if self.model != 'cnn':
+            # dlib's HOG detector has no batched variant
+            return [face_recognition.face_locations(image, model=self.model) for image in images]
+
+        # The CNN detector can only batch images of the same size (i.e. from the same type of camera)
+        locations = [None] * len(images)
+        by_shape = {}
+        for index, image in enumerate(images):
+            by_shape.setdefault(image.shape, []).append(index)
+        for indices in by_shape.values():
+            same_size = [images[index] for index in indices]
+            for index, face_locations in zip(indices, face_recognition.batch_face_locations(
+                    same_size, number_of_times_to_upsample=1, batch_size=len(same_size))):
+                locations[index] = face_locations
+        return locations
+
+    @staticmethod
+    def encode_faces(images, batch_face_locations):
+        # Equal to face_recognition.face_encodings, but with a single descriptor computation for all images
+        batch_images = []
+        batch_landmarks = []
+        for image, face_locations in zip(images, batch_face_locations):
+            if face_locations:
+                landmarks = full_object_detections()
+                for top, right, bottom, left in face_locations:
+                    landmarks.append(pose_predictor_5_point(image, rectangle(left, top, right, bottom)))
+                batch_images.append(image)
+                batch_landmarks.append(landmarks)
+
+        descriptors = iter(face_encoder.compute_face_descriptor(batch_images, batch_landmarks, 1)
+                           if batch_images else [])
+        return [[array(descriptor) for descriptor in next(descriptors)] if face_locations else []
+                for face_locations in batch_face_locations]
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -0,0 +1,19 @@
+from cbsr.factory import CBSRfactory
+
+from frame_distribution_service import FrameDistributionService
+
+
+class FrameDistributionFactory(CBSRfactory):
+    def __init__(self):
+        super(FrameDistributionFactory, self).__init__()
+
+    def get_connection_channel(self):
+        return 'frame_distribution'
+
+    def create_service(self, connect, identifier, disconnect):
+        return FrameDistributionService(connect, identifier, disconnect)
+
+
+if __name__ == '__main__':
+    frame_distribution_factory = FrameDistributionFactory()
+    frame_distribution_factory.run()
@@ -0,0 +1,71 @@
+from os import getenv, remove
+from threading import Thread
+
+from cbsr.frame import create_frame_source
+from cbsr.frame_ring import FrameRingWriter, get_ring_path
+from cbsr.service import CBSRservice, FrameSlot
+
+
+class FrameDistributionService(CBSRservice):
+    def __init__(self, connect, identifier, disconnect):
+        # Frames are fetched from Redis (through the configured FRAME_TRANSPORT)
+        self.frame_source = create_frame_source('rgb', shared=False)
+        # Only the latest frame that was announced is processed (see FrameSlot)
+        self.frame_slot = FrameSlot(self.__class__.__name__)
+        super(FrameDistributionService, self).__init__(connect, identifier, disconnect)
+        self.frame_source.start(self)
+
+        # The ring file that the vision services on this host read the decoded frames from
+        self.ring_path = get_ring_path(getenv('FRAME_RING_DIR'), identifier)
+        # Thread data
+        self.is_distributing = False
+
+    def get_device_types(self):
+        return ['cam']
+
+    def get_channel_action_mapping(self):
+        mapping = {self.get_full_channel('events'): self.execute}
+        mapping.update(self.frame_source.get_channel_action_mapping(self, self.frame_slot.put))
+        return mapping
+
+    def execute(self, message):
+        data = message['data'].decode('utf-8')
+        if data == 'WatchingStarted':
+            if not self.is_distributing:
+                self.is_distributing = True
+                self.frame_slot.open()
+                frame_distribution_thread = Thread(target=self.distribute_frames)
+                frame_distribution_thread.start()
+            else:
+                print('Frame distribution already running for ' + self.identifier)
+        elif data == 'WatchingDone':
+            if self.is_distributing:
+                self.is_distributing = False
+                self.frame_slot.close()
+            else:
+                print('Frame distribution already stopped for ' + self.identifier)
+
+    def distribute_frames(self):
+        writer = FrameRingWriter(self.ring_path)
+        while self.is_distributing:
+            if self.frame_slot.take() is None:
+                continue  # stopped
+
+            # Get the frame from Redis (once for all vision services on this host)
+            image = self.frame_source.fetch(self)
+            if image is None:
+                continue
+
+            timestamp = self.frame_source.timestamp
+            seq = writer.write(image, timestamp)
+            self.publish('frame_available', str(seq) + ';' + str(timestamp))
+        writer.close()
+        print(self.identifier + ': ' + str(self.frame_slot))
+
+    def cleanup(self):
+        self.is_distributing = False
+        self.frame_slot.close()
+        try:
+            remove(self.ring_path)
+        except OSError:
+            pass
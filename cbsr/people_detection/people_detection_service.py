@@ -1,39 +1,39 @@
-from io import BytesIO
-from threading import Event, Thread
+from threading import Thread
 
-from PIL import Image
-from cbsr.service import CBSRservice
+from cbsr.frame import create_frame_source
+from cbsr.service import CBSRservice, FrameSlot
+from cv2 import cvtColor, imencode, COLOR_RGB2BGR
 from face_recognition import face_locations
-from numpy import array, frombuffer, ones, uint8, reshape
 
 
 class PeopleDetectionService(CBSRservice):
     def __init__(self, connect, identifier, disconnect):
+        # Frames are fetched from Redis, or from the frame distribution service if available
+        self.frame_source = create_frame_source('rgb')
+        # Only the latest frame that was announced is processed (see FrameSlot)
+        self.frame_slot = FrameSlot(self.__class__.__name__)
         super(PeopleDetectionService, self).__init__(connect, identifier, disconnect)
+        self.frame_source.start(self)
 
-        # Image size (filled later)
-        self.image_width = 0
-        self.image_height = 0
-        self.color_space = None
         # Thread data
         self.is_detecting = False
         self.save_image = False
-        self.is_image_available = False
-        self.image_available_flag = Event()
 
     def get_device_types(self):
         return ['cam']
 
     def get_channel_action_mapping(self):
-        return {self.get_full_channel('events'): self.execute,
-                self.get_full_channel('image_available'): self.set_image_available,
-                self.get_full_channel('action_take_picture'): self.take_picture}
+        mapping = {self.get_full_channel('events'): self.execute,
+                   self.get_full_channel('action_take_picture'): self.take_picture}
+        mapping.update(self.frame_source.get_channel_action_mapping(self, self.frame_slot.put))
+        return mapping
 
     def execute(self, message):
         data = message['data']
         if data == 'WatchingStarted':
             if not self.is_detecting:
                 self.is_detecting = True
+                self.frame_slot.open()
                 people_detection_thread = Thread(target=self.detect_people)
                 people_detection_thread.start()
             else:
@@ -41,68 +41,37 @@ class PeopleDetectionService(CBSRservice):
         elif data == 'WatchingDone':
             if self.is_detecting:
                 self.is_detecting = False
-                self.image_available_flag.set()
+                self.frame_slot.close()
             else:
                 print('People detection already stopped for ' + self.identifier)
 
     def detect_people(self):
         self.produce_event('PeopleDetectionStarted')
         while self.is_detecting:
-            if self.is_image_available:
-                self.is_image_available = False
-                self.image_available_flag.clear()
+            if self.frame_slot.take() is None:
+                continue  # stopped
 
-                # Get the raw bytes from Redis
-                image_stream = self.redis.get(self.get_full_channel('image_stream'))
-                if self.image_width == 0 or self.image_height == 0:
-                    image_size = self.redis.get(self.get_full_channel('image_size')).split()
-                    self.image_width = int(image_size[0])
-                    self.image_height = int(image_size[1])
-                    self.color_space = image_size[2]
+            image = self.frame_source.fetch(self)
+            if image is None:
+                continue
 
-                if self.color_space == 'RGB':
-                    image = Image.frombytes('RGB', (self.image_width, self.image_height), image_stream)
-                elif self.color_space == 'YUV':
-                    # YUV type juggling (end up with YUV444 which is YCbCr which PIL can read directly)
-                    image_array = frombuffer(image_stream, dtype=uint8)
-                    y = image_array[0::2]
-                    u = image_array[1::4]
-                    v = image_array[3::4]
-                    yuv = ones((len(y)) * 3, dtype=uint8)
-                    yuv[::3] = y
-                    yuv[1::6] = u
-                    yuv[2::6] = v
-                    yuv[4::6] = u
-                    yuv[5::6] = v
-                    yuv = reshape(yuv, (self.image_height, self.image_width, 3))
-                    image = Image.fromarray(yuv, 'YCbCr').convert('RGB')
-                else:
-                    print('Unknown color space: ' + self.color_space)
-                    continue
+            if self.save_image:  # If image needs to be saved, publish JPEG back on Redis
+                _, jpeg = imencode('.jpg', cvtColor(image, COLOR_RGB2BGR))
+                self.publish('picture_newfile', jpeg.tobytes())
+                self.save_image = False
 
-                if self.save_image:  # If image needs to be saved, publish JPEG back on Redis
-                    bytes_io = BytesIO()
-                    image.save(bytes_io, 'JPEG')
-                    self.publish('picture_newfile', bytes_io.getvalue())
-                    self.save_image = False
-
-                # Do the actual detection
-                faces = face_locations(array(image))
-                if faces:
-                    print(self.identifier + ': Detected Person!')
-                    self.publish('detected_person', '')
-            else:
-                self.image_available_flag.wait()
+            # Do the actual detection
+            with self.measure('detect'):
+                faces = face_locations(image)
+            if faces:
+                print(self.identifier + ': Detected Person!')
+                self.publish('detected_person', '', self.frame_source.trace)
+        print(self.identifier + ': ' + str(self.frame_slot))
         self.produce_event('PeopleDetectionDone')
 
-    def set_image_available(self, message):
-        if not self.is_image_available:
-            self.is_image_available = True
-            self.image_available_flag.set()
-
     def take_picture(self, message):
         self.save_image = True
 
     def cleanup(self):
-        self.image_available_flag.set()
         self.is_detecting = False
+        self.frame_slot.close()
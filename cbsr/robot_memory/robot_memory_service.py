@@ -1,4 +1,7 @@
 from datetime import datetime
+from queue import Queue
+from threading import Thread
+
 from redis import DataError
 from simplejson import loads
 from cbsr.service import CBSRservice
@@ -14,20 +17,46 @@ class InteractantDoesNotExistError(Exception):
     pass
 
 
+DELETE_BATCH_SIZE = 500  # keys per UNLINK
+
+
 class RobotMemoryService(CBSRservice):
     def __init__(self, connect, identifier, disconnect):
+        # The requests are handled (in order) by a thread of this service, as the handlers of the shared
+        # pubsub must not block the other services with their database actions (e.g. deleting all interactants)
+        self.requests = Queue()
+        requests_thread = Thread(target=self.handle_requests)
+        requests_thread.daemon = True
+        requests_thread.start()
         super(RobotMemoryService, self).__init__(connect, identifier, disconnect)
 
     def get_device_types(self):
         return ['robot']
 
     def get_channel_action_mapping(self):
-        return {self.get_full_channel('memory_add_entry'): self.add_entry,
-                self.get_full_channel('memory_set_session'): self.set_session,
-                self.get_full_channel('memory_set_interactant_data'): self.set_interactant_data,
-                self.get_full_channel('memory_get_interactant_data'): self.get_interactant_data,
-                self.get_full_channel('memory_delete_interactant'): self.delete_interactant,
-                self.get_full_channel('memory_delete_all_interactants'): self.delete_all_interactants}
+        return {self.get_full_channel('memory_add_entry'): self.enqueue(self.add_entry),
+                self.get_full_channel('memory_set_session'): self.enqueue(self.set_session),
+                self.get_full_channel('memory_set_interactant_data'): self.enqueue(self.set_interactant_data),
+                self.get_full_channel('memory_get_interactant_data'): self.enqueue(self.get_interactant_data),
+                self.get_full_channel('memory_delete_interactant'): self.enqueue(self.delete_interactant),
+                self.get_full_channel('memory_delete_all_interactants'): self.enqueue(self.delete_all_interactants)}
+
+    def enqueue(self, handler):
+        return lambda message: self.requests.put((handler, message))
+
+    def handle_requests(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            handler, message = request
+            try:
+                handler(message)
+            except Exception as err:
+                print(self.identifier + ' > Handling a memory request has failed: ' + str(err))
+
+    def cleanup(self):
+        self.requests.put(None)
 
     def set_session(self, message):
         """Called to indicate that a new session has started.
@@ -99,27 +128,33 @@ class RobotMemoryService(CBSRservice):
         try:
             # retrieve data from message
             interactant_id = self.get_data(message, 1, correct_format='interactant_id')[0]
-            # get all entries attached to this interactant
-            entries = list(self.redis.scan_iter(self.get_user_id() + ':' + interactant_id + ':entry:*'))
-            # add reference to interactant
-            entries.append(self.get_interactant_key(interactant_id))
-            # delete all entries and interactant
-            self.redis.delete(*entries)
+            # delete all entries attached to this interactant, and the interactant itself
+            self.delete_matching(self.get_user_id() + ':' + interactant_id + ':entry:*')
+            self.redis.unlink(self.get_interactant_key(interactant_id))
             self.produce_event('InteractantDeleted')
         except EntryIncorrectFormatError as err:
             print(self.identifier + ' > Could not delete interactant due to: ' + str(err))
 
     def delete_all_interactants(self, message):
         try:
-            # get all interactants and related entries
-            interactants = list(self.redis.scan_iter(self.get_interactant_key('*')))
-            entries = list(self.redis.scan_iter(self.get_user_id() + ':*:entry:*'))
             # delete all interactants and related entries
-            self.redis.delete(*(interactants + entries))
+            self.delete_matching(self.get_interactant_key('*'))
+            self.delete_matching(self.get_user_id() + ':*:entry:*')
             self.produce_event('AllInteractantsDeleted')
         except DataError as err:
             print(self.identifier + ' > Could not delete all interactants due to: ' + str(err))
 
+    def delete_matching(self, pattern):
+        """Delete the keys that match the pattern in batches, which Redis frees in the background (UNLINK)"""
+        batch = []
+        for key in self.redis.scan_iter(pattern, count=DELETE_BATCH_SIZE):
+            batch.append(key)
+            if len(batch) == DELETE_BATCH_SIZE:
+                self.redis.unlink(*batch)
+                batch = []
+        if batch:
+            self.redis.unlink(*batch)
+
     def produce_data(self, key, value):
         self.publish('memory_data', str(key) + ';' + str(value))
 
@@ -11,6 +11,7 @@ class CBSRdevice(object):
     def __init__(self, server, username, password, profiling):
         self.username = username
         self.running = True
+        self.stream_seqs = {}
 
         if profiling:
             self.profiler_queue = Queue()
@@ -76,6 +77,22 @@ class CBSRdevice(object):
     def produce(self, value):
         self.publish('events', value)
 
+    def get_transport(self, channel):
+        """
+        :return: the transport the server requested for a channel ('stream'), or None for the default publish/get
+        """
+        return self.redis.get(self.get_full_channel(channel + '_transport'))
+
+    def produce_stream(self, channel, fields, maxlen=1):
+        """
+        Add an entry to a Redis stream, so that consumers get the data itself in the notification.
+        Only the last maxlen entries are kept; a sequence number is added so consumers can count what they missed.
+        """
+        seq = self.stream_seqs.get(channel, 0) + 1
+        self.stream_seqs[channel] = seq
+        fields['seq'] = seq
+        self.redis.xadd(self.get_full_channel(channel), fields, maxlen=maxlen, approximate=False)
+
     def profiling_start(self):
         return default_timer() if self.profiler_queue else None
 
@@ -7,6 +7,12 @@ from time import sleep
 from cbsr.device import CBSRdevice
 from qi import Application
 
+try:  # only needed for JPEG compressed frames
+    from cv2 import cvtColor, imencode, COLOR_YUV2BGR_YUYV, IMWRITE_JPEG_QUALITY
+    from numpy import frombuffer, uint8
+except ImportError:
+    imencode = None
+
 
 class VideoProcessingModule(CBSRdevice):
     def __init__(self, session, name, server, username, password, profiling):
@@ -24,11 +30,14 @@ class VideoProcessingModule(CBSRdevice):
         self.video_service = session.service('ALVideoDevice')
         self.module_name = name
         self.color_index = 9  # native YUV422 (same for normal or stereo)
+        self.jpeg_quality = 0  # no JPEG compression by default
+        self.image_size = None
         self.camera_index = 0  # top camera by default
         self.resolution_index = 2
         self.index = -1
         self.is_robot_watching = False
         self.subscriber_id = None
+        self.use_stream = False
 
         super(VideoProcessingModule, self).__init__(server, username, password, profiling)
 
@@ -66,14 +75,25 @@ class VideoProcessingModule(CBSRdevice):
             print('Using stereo camera at 1280x360...')
             self.camera_index = 3  # stereo camera
             self.resolution_index = 14
-            self.redis.set(self.get_full_channel('image_size'), '1280 360 YUV')
+            width, height = 1280, 360
         else:
             print('Using top camera at 640x480...')
             self.camera_index = 0  # top camera
             self.resolution_index = 2
             if self.robot_type == 'pepper':  # enable auto-focus on Pepper
                 self.video_service.setParameter(self.camera_index, 40, 1)
-            self.redis.set(self.get_full_channel('image_size'), '640 480 YUV')
+            width, height = 640, 480
+
+        # the server can ask for smaller frames, which is advertised in the image size
+        image_format = self.redis.get(self.get_full_channel('image_format'))
+        width, height, color_space = self.set_image_format(image_format, width, height)
+        self.image_size = str(width) + ' ' + str(height) + ' ' + color_space
+        self.redis.set(self.get_full_channel('image_size'), self.image_size)
+
+        # the server can ask for the frames to be sent through a stream instead of a set + publish
+        self.use_stream = (self.get_transport('image') == 'stream')
+        if self.use_stream:
+            print('Sending frames through a stream...')
 
         self.subscriber_id = self.video_service.subscribeCamera(self.module_name, self.camera_index,
                                                                 self.resolution_index, self.color_index, self.frame_ps)
@@ -88,6 +108,41 @@ class VideoProcessingModule(CBSRdevice):
             t = Thread(target=self.wait, args=(seconds, self.index))
             t.start()
 
+    def set_image_format(self, image_format, width, height):
+        # the format is a combination of 'small', 'gray' and 'jpeg[:quality]', e.g. 'small+gray' or 'jpeg:80'
+        self.color_index = 9  # native YUV422
+        self.jpeg_quality = 0
+        color_space = 'YUV'
+        for option in (image_format or '').split('+'):
+            if option == 'small' and self.camera_index == 0:
+                self.resolution_index = 1  # 320x240
+                width, height = 320, 240
+            elif option == 'gray':
+                self.color_index = 0  # only the Y channel of YUV422
+                color_space = 'Y'
+            elif option.startswith('jpeg'):
+                if imencode is None:
+                    print('JPEG compression is not available (no OpenCV)')
+                else:
+                    self.jpeg_quality = int(option[5:]) if option.startswith('jpeg:') else 80
+                    color_space = 'JPEG'
+        if image_format:
+            print('Using image format ' + image_format + ' (' + str(width) + 'x' + str(height) + ' ' + color_space + ')')
+        return width, height, color_space
+
+    def encode_image(self, nao_image):
+        image_bytes = bytes(nao_image[6])
+        if not self.jpeg_quality:
+            return image_bytes
+
+        width, height = nao_image[0], nao_image[1]
+        if self.color_index == 0:
+            image = frombuffer(image_bytes, dtype=uint8).reshape((height, width))
+        else:
+            image = cvtColor(frombuffer(image_bytes, dtype=uint8).reshape((height, width, 2)), COLOR_YUV2BGR_YUYV)
+        _, jpeg = imencode('.jpg', image, [IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        return jpeg.tobytes()
+
     def wait(self, seconds, my_index):
         sleep(seconds)
         if self.is_robot_watching and self.index == my_index:
@@ -108,11 +163,18 @@ class VideoProcessingModule(CBSRdevice):
             if nao_image is not None:
                 unix_time_millis = int((datetime.utcnow() - self.epoch).total_seconds() * 1000.0)
                 self.profiling_end('GET_REMOTE', get_remote_start)
+                encode_img_start = self.profiling_start()
+                image_bytes = self.encode_image(nao_image)
+                self.profiling_end('ENCODE_IMG', encode_img_start)
                 send_img_start = self.profiling_start()
-                pipe = self.redis.pipeline()
-                pipe.set(self.get_full_channel('image_stream'), bytes(nao_image[6]))
-                pipe.publish(self.get_full_channel('image_available'), str(unix_time_millis))
-                pipe.execute()
+                if self.use_stream:
+                    self.produce_stream('image_frames', {'image': image_bytes, 'time': str(unix_time_millis),
+                                                         'size': self.image_size})
+                else:
+                    pipe = self.redis.pipeline()
+                    pipe.set(self.get_full_channel('image_stream'), image_bytes)
+                    pipe.publish(self.get_full_channel('image_available'), str(unix_time_millis))
+                    pipe.execute()
                 self.profiling_end('SEND_IMG', send_img_start)
             sleep(self.polling_sleep)
 